@@ -1,18 +1,35 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import shutil
 import time
 from datetime import timedelta
 import math
-from analyzertools import passwordtools, parameters, database, masktools
+import multiprocessing
+from collections import deque, Counter
+from functools import partial
+from itertools import islice
+from analyzertools.dedupstore import iterate_collection_as_tuples, iterate_sorted_difference
+from analyzertools import passwordtools, parameters, database, masktools, potreader, bloomfilter, leetspeak, \
+    analysisstate, checkpoint, profiling, progress, streaming, scoring, hashcatrules, potcache
 
 data_handler = None
 word_extractor = passwordtools.WordExtractor()
-masks = {}
+masks = Counter()
+literal_fragments = masktools.FragmentCounter()
 ordered_mask_list = []
 password_count = 0
 omission_count = 0
+profiler = profiling.PipelineProfiler()
+prioritized_candidates = None
+derivation_batch_size = 256
+potfile_block_size = 4096
+output_block_size = 4096
+output_buffer_size = 1024 * 1024
+shards_per_worker = 4
+minimum_reported_occurrences = 2
+minimum_reported_percentage = 0.01
 
 
 def print_usage():
@@ -20,30 +37,43 @@ def print_usage():
     [-o, --output OUTPUT_NAME]                  Give the output files a unique prefix
     [-a, --analyze-only]                        Skip generating derivatives, only analyze the potfile (very fast)
     [-w, --mask-weight-cutoff CUTOFF]           Between 0 and 1, basically how large to make the mask attack file (default 0.3)
+    [--hash-rate HASHES_PER_SECOND]             Estimate the runtime of each mask in the .hcmask file at this hash rate
+    [--time-budget SECONDS]                     Pick the masks expected to crack the most passwords within this time (needs --hash-rate)
     [-p, --previous-passwords PASSWORD_LIST]    Include a potfile or word list to omit from derivative generation
+    [--omission-filter FILTER_FILE]             Load the previous password filter from this file, or build and save it there
+    [--omission-fp-rate RATE]                   False positive rate of the previous password filter (default 0.001)
+    [--approximate-omissions]                   Only use the filter for omissions, skipping the exact check
     [-d, --depth DEPTH]                         How many times to recursively re-process derivative results (default 1, exponentially intensive)
     [-l, --deriver-length-limit]                Character length limit of passwords used to generate derivatives (default 16)
-    [-h, --help]                                Show this help output""" % sys.argv[0])
-
-
-def print_progress(prefix_comment, completed, total, time_left=None):
-    percent = (float(completed) / float(total)) * 100
-    if time_left is None or len(time_left) == 0:
-        sys.stdout.write("%s %d/%d (%.2f%%)" % (prefix_comment, completed, total, percent))
-    else:
-        sys.stdout.write("%s %d/%d (%.2f%%) Estimated time remaining: %s" % (prefix_comment, completed, total,
-                                                                             percent, time_left))
-    sys.stdout.flush()
-
-
-def get_estimated_time_remaining(percentage_complete, progress_start_time):
-    time_elapsed = time.time() - progress_start_time
-    if time_elapsed > 0:
-        completion_rate = percentage_complete / time_elapsed
-        remaining_percentage = 1.00 - percentage_complete
-        seconds_left = round(remaining_percentage / completion_rate)
-        return str(timedelta(seconds=seconds_left))
-    return "Unknown"
+    [--leet-max-substitutions COUNT]            Limit leetspeak derivatives to this many substituted characters
+    [--leet-max-candidates COUNT]               Limit the number of leetspeak derivatives generated per password
+    [--leet-top-k COUNT]                        Only keep the most likely leetspeak derivatives, ranked by the potfile
+    [-j, --workers WORKERS]                     Number of processes used to generate derivatives, or to analyze the potfile with -a (default 1)
+    [--dedup-backend BACKEND]                   Derivative dedup store: sqlite, hashset or spill (default sqlite)
+    [--memory-budget MEGABYTES]                 Memory budget shared by derivative dedup, the SQLite cache and prioritizing, spilling sorted runs to disk (implies spill)
+    [--temp-dir DIRECTORY]                      Directory for spilled runs (default system temp directory)
+    [-i, --incremental]                         Only process potfile lines appended since the previous incremental run
+    [--state-dir DIRECTORY]                     Where incremental analysis state is kept (default potanalyzer_state)
+    [--checkpoint-interval SECONDS]             Periodically checkpoint derivative generation so it can be resumed
+    [--checkpoint-dir DIRECTORY]                Where checkpoints are kept (default potanalyzer_checkpoint)
+    [--resume]                                  Resume derivative generation from the last checkpoint
+    [--stats-json STATS_FILE]                   Record wall/CPU time, peak memory and throughput per pipeline stage as JSON
+    [--profile PSTATS_FILE]                     Save a cProfile dump of derivative generation (parent process only)
+    [--stream TARGET]                           Write unique derivatives to TARGET as they are generated, "-" for stdout or a named pipe
+    [--stream-capacity COUNT]                   Expected number of streamed derivatives, sizes the dedup filter (default %d)
+    [--stream-fp-rate RATE]                     False positive rate of the streaming dedup filter (default 0.001)
+    [--prioritize]                              Write derivatives most likely first, scored by mask, word, edit type and depth
+    [--max-candidates COUNT]                    Only write the COUNT highest scoring derivatives (implies --prioritize)
+    [--hashcat-rules]                           Write a ranked hashcat rule file and base wordlist instead of derivatives
+    [--max-word-variants COUNT]                 Only keep the COUNT most common spellings of each common word
+    [--output-max-depth DEPTH]                  Only output candidates first generated at or below this depth (0 is the potfile)
+    [--cache CACHE_FILE]                        Read the potfile from this cache when it is up to date (default POTFILE.pacache)
+    [--hash-fields COUNT]                       Number of ":" separated hash fields before the plaintext, so plaintexts may contain ":"
+    [-h, --help]                                Show this help output
+usage: %s index /your/potfile/path
+    [--cache CACHE_FILE]                        Where to write the potfile cache (default POTFILE.pacache)
+    [--hash-fields COUNT]                       Number of ":" separated hash fields before the plaintext""" %
+          (sys.argv[0], streaming.default_stream_capacity, sys.argv[0]))
 
 
 def collection_to_pretty_string(collection):
@@ -58,60 +88,301 @@ def collection_to_pretty_string(collection):
     return "".join(string_builder)
 
 
-def import_password_omissions(filename):
+def import_password_omissions(filename, filter_filename=None,
+                              false_positive_rate=bloomfilter.default_false_positive_rate, exact=True):
     global omission_count
+    if filter_filename is not None and os.path.exists(filter_filename):
+        try:
+            print("Loading previous password filter...")
+            omission_filter = bloomfilter.BloomFilter.load(filter_filename)
+            data_handler.set_omission_filter(omission_filter, exact=False)
+            omission_count = omission_filter.item_count
+            return
+        except (IOError, ValueError):
+            print("The provided previous password filter was invalid, rebuilding it.")
+    if filename is None:
+        print("No previous password file was provided to build the filter from.")
+        return
     try:
-        with open(filename, "r") as previous_passwords:
-            print("Importing previous password file...")
-            for line in previous_passwords.readlines():
-                line_split = line.strip().split(":")
-                if len(line_split) == 1:
-                    password = line_split[0]
-                else:
-                    password = line_split[len(line_split)-1]
-                if len(password) == 0:
-                    continue
-                data_handler.add_omitted_password(password)
-                omission_count += 1
+        reader = potreader.PotfileReader(filename)
+        print("Importing previous password file...")
+        omission_filter = bloomfilter.BloomFilter(reader.count_lines(), false_positive_rate)
+        data_handler.set_omission_filter(omission_filter, exact)
+        for password in reader.iterate_plaintexts(require_hash=False):
+            data_handler.add_omitted_password(password, auto_commit=False)
+            omission_count += 1
+        data_handler.commit()
+        print("Read %s" % reader.get_throughput_str())
+        if filter_filename is not None:
+            omission_filter.save(filter_filename)
+            print("Previous password filter saved to '%s'" % filter_filename)
     except IOError:
         print("The provided previous password file was invalid or could not be found.")
 
 
-def import_potfile(filename):
+def analyze_password_block(password_block, block_word_extractor, block_masks, block_fragments):
+    block_word_extractor.extract_many(password_block)
+    masktools.count_mask_codes(password_block, block_masks)
+    masktools.count_literal_fragments(password_block, block_fragments)
+
+
+def process_potfile_block(password_block):
+    data_handler.stage_many_passwords(password_block, auto_commit=False)
+    analyze_password_block(password_block, word_extractor, masks, literal_fragments)
+
+
+def import_potfile(filename, start_offset=0, include_partial_line=True, hash_fields=None):
     global password_count
     try:
-        with open(filename, "r") as potfile:
+        reader = potreader.PotfileReader(filename, start_offset=start_offset, include_partial_line=include_partial_line)
+        if start_offset > 0:
+            print("Importing passwords appended to the potfile since the previous run...")
+        else:
             print("Importing passwords from potfile...")
-            for line in potfile.readlines():
-                line_split = line.strip().split(":")
-                if len(line_split) < 2:
-                    continue
-                password = line_split[len(line_split)-1]
-                if len(password) == 0:
-                    continue
-                if data_handler.password_is_omitted(password):
-                    continue
-                data_handler.stage_password(password, auto_commit=False)
-                word_extractor.extract(password)
-                mask = masktools.get_mask(password)
-                mask_key = "".join(mask)
-                if mask_key in masks.keys():
-                    masks[mask_key] = masks[mask_key] + 1
-                else:
-                    masks[mask_key] = 1
-                password_count += 1
-            data_handler.commit()
+        password_block = []
+        chunk_offsets = potreader.get_chunk_offsets(filename, start_offset=start_offset)
+        for password in reader.iterate_plaintexts(hash_fields=hash_fields, chunk_offsets=chunk_offsets):
+            if password is None:
+                process_potfile_block(password_block)
+                password_block = []
+                literal_fragments.prune()
+                continue
+            if data_handler.password_is_omitted(password):
+                continue
+            password_block.append(password)
+            password_count += 1
+            if len(password_block) >= potfile_block_size:
+                process_potfile_block(password_block)
+                password_block = []
+        process_potfile_block(password_block)
+        literal_fragments.prune()
+        data_handler.commit()
+        print("Read %s" % reader.get_throughput_str())
+        return reader.end_offset
     except IOError:
         print("The provided pot file was invalid or could not be found.")
+        return None
+
+
+def analyze_potfile_shard(filename, start_offset, stop_offset, include_partial_line, max_word_variants, hash_fields):
+    reader = potreader.PotfileReader(filename, start_offset=start_offset, include_partial_line=include_partial_line,
+                                     stop_offset=stop_offset)
+    shard_word_extractor = passwordtools.WordExtractor(max_word_variants)
+    shard_masks = Counter()
+    shard_fragments = masktools.FragmentCounter()
+    shard_password_count = 0
+    password_block = []
+    for password in reader.iterate_plaintexts(hash_fields=hash_fields):
+        password_block.append(password)
+        shard_password_count += 1
+        if len(password_block) >= potfile_block_size:
+            analyze_password_block(password_block, shard_word_extractor, shard_masks, shard_fragments)
+            password_block = []
+    analyze_password_block(password_block, shard_word_extractor, shard_masks, shard_fragments)
+    return shard_password_count, shard_masks, shard_fragments, shard_word_extractor, reader.end_offset, \
+        reader.bytes_read
+
+
+def import_potfile_sharded(filename, workers, start_offset=0, include_partial_line=True, hash_fields=None):
+    global password_count
+    try:
+        # Shards never span a chunk offset, so fragments are pruned at the same offsets as a serial import
+        chunk_offsets = set(potreader.get_chunk_offsets(filename, start_offset=start_offset))
+        shard_offsets = sorted(chunk_offsets.union(potreader.get_shard_offsets(filename, workers * shards_per_worker,
+                                                                               start_offset)))
+        print("Analyzing potfile in %d shards with %d workers..." % (len(shard_offsets), workers))
+        shards = []
+        for i in range(len(shard_offsets)):
+            if i + 1 < len(shard_offsets):
+                shards.append((filename, shard_offsets[i], shard_offsets[i + 1], True, word_extractor.max_variants,
+                               hash_fields))
+            else:
+                shards.append((filename, shard_offsets[i], None, include_partial_line, word_extractor.max_variants,
+                               hash_fields))
+        start_time = time.time()
+        bytes_read = 0
+        end_offset = start_offset
+        with multiprocessing.Pool(workers) as pool:
+            for shard, (shard_password_count, shard_masks, shard_fragments, shard_word_extractor, end_offset,
+                        shard_bytes_read) in zip(shards, pool.starmap(analyze_potfile_shard, shards, chunksize=1)):
+                password_count += shard_password_count
+                masks.update(shard_masks)
+                literal_fragments.merge(shard_fragments)
+                if shard[2] in chunk_offsets:
+                    literal_fragments.prune()
+                word_extractor.merge(shard_word_extractor)
+                bytes_read += shard_bytes_read
+        literal_fragments.prune()
+        elapsed = max(time.time() - start_time, 1e-9)
+        print("Read %.2f MB in %s (%.2f MB/s)" % (bytes_read / 1048576.0, str(timedelta(seconds=round(elapsed, 2))),
+                                                 bytes_read / elapsed / 1048576.0))
+        return end_offset
+    except IOError:
+        print("The provided pot file was invalid or could not be found.")
+        return None
+
+
+def import_potfile_cache(potfile_cache, stage_passwords=True):
+    global password_count
+    print("Importing passwords from potfile cache...")
+    start_time = time.time()
+    if not data_handler.has_omissions:
+        cached_masks, cached_fragments, cached_word_extractor = potfile_cache.load_summary()
+        masks.update(cached_masks)
+        literal_fragments.merge(cached_fragments)
+        literal_fragments.prune()
+        word_extractor.merge(cached_word_extractor)
+        password_count += potfile_cache.password_count
+        if stage_passwords:
+            for password_block in potfile_cache.iterate_plaintext_blocks(potfile_block_size):
+                data_handler.stage_many_passwords(password_block, auto_commit=False)
+    else:
+        # Omitted plaintexts are not in the cached summary, so the kept ones are analyzed once each
+        for password_block, mask_code_block, count_block in potfile_cache.iterate_blocks(potfile_block_size):
+            kept_entries = [entry for entry in zip(password_block, mask_code_block, count_block)
+                            if not data_handler.password_is_omitted(entry[0])]
+            password_block = [entry[0] for entry in kept_entries]
+            mask_code_block = [entry[1] for entry in kept_entries]
+            count_block = [entry[2] for entry in kept_entries]
+            if stage_passwords:
+                data_handler.stage_many_passwords(password_block, auto_commit=False)
+            potcache.analyze_weighted_block(password_block, mask_code_block, count_block, word_extractor, masks,
+                                            literal_fragments)
+            literal_fragments.prune()
+            password_count += sum(count_block)
+    data_handler.commit()
+    elapsed = max(time.time() - start_time, 1e-9)
+    print("Read %d cached passwords in %s (%.0f passwords/s)" % (potfile_cache.entry_count,
+                                                                 str(timedelta(seconds=round(elapsed, 2))),
+                                                                 potfile_cache.entry_count / elapsed))
+    return potfile_cache.potfile_size
+
+
+def load_potfile_cache(params):
+    if not os.path.exists(params.cache_name):
+        return None
+    try:
+        potfile_cache = potcache.PotfileCache(params.cache_name)
+    except (IOError, ValueError):
+        print("The potfile cache '%s' is invalid, reading the potfile." % params.cache_name)
+        return None
+    if not potfile_cache.matches_potfile(params.potfile_name, params.hash_fields):
+        print("The potfile cache '%s' is out of date or was built with other --hash-fields, reading the potfile." %
+              params.cache_name)
+        potfile_cache.close()
+        return None
+    return potfile_cache
+
+
+def index_potfile(params):
+    try:
+        print("Indexing potfile...")
+        entry_count, cached_password_count, reader = potcache.build_cache(params.potfile_name, params.cache_name,
+                                                                          params.hash_fields, params.temp_dir)
+        print("Read %s" % reader.get_throughput_str())
+        print("* * *")
+        print("Potfile cache saved to '%s'" % params.cache_name)
+        print("Passwords indexed from potfile: %d (%d unique)" % (cached_password_count, entry_count))
+    except IOError:
+        print("The provided pot file was invalid or the cache could not be written.")
+
+
+def get_analysis_settings(params):
+    if params.analyze_only:
+        return params.hash_fields
+    return (analysisstate.get_file_signature(params.previous_passwords),
+            analysisstate.get_file_signature(params.omission_filter_name),
+            params.exact_omissions, params.hash_fields)
+
+
+def get_derivation_settings(params):
+    if params.analyze_only:
+        return None
+    return (params.depth, params.derivative_base_length_limit, params.leet_max_substitutions,
+            params.leet_max_candidates, params.leet_top_k, params.output_max_depth, params.max_candidates,
+            params.hashcat_rules, params.prioritize)
+
+
+def load_incremental_state(params):
+    global word_extractor, masks, literal_fragments, password_count
+    previous_state = analysisstate.load_state(params.state_dir)
+    if previous_state is None:
+        print("No previous analysis state found in '%s', processing the full potfile." % params.state_dir)
+        return None
+    if not previous_state.matches_potfile(params.potfile_name) or \
+            not previous_state.matches_settings(get_analysis_settings(params), get_derivation_settings(params)) or \
+            previous_state.word_extractor.max_variants != params.max_word_variants:
+        print("The potfile or settings changed since the previous run, processing the full potfile.")
+        return None
+    word_extractor = previous_state.word_extractor
+    masks = previous_state.masks
+    literal_fragments = previous_state.literal_fragments
+    password_count = previous_state.password_count
+    return previous_state
+
+
+def import_carried_derivatives(analysis_state, state_dir):
+    # Carried derivatives keep the edit score they were generated with and are scored with this run's masks and
+    # words, the same as a full run would score them
+    carried_rows = iterate_collection_as_tuples(analysis_state.iterate_scored_derivatives(state_dir))
+    for carried_block in iterate_password_batches(carried_rows, potfile_block_size):
+        prioritized_candidates.add_many(scoring.worker_scorer.rescore_many(carried_block))
+
+
+def record_incremental_derivatives(analysis_state, state_dir):
+    # Only the derivatives new to this run are deduplicated against the sorted previous runs and stored
+    try:
+        has_previous_derivatives = analysis_state.has_derivatives
+        if has_previous_derivatives:
+            print("Merging derivatives from the previous run...")
+        if prioritized_candidates is not None:
+            analysis_state.add_scored_derivative_run(state_dir, prioritized_candidates.iterate_edit_scores())
+            if has_previous_derivatives:
+                import_carried_derivatives(analysis_state, state_dir)
+            return None
+        new_derivatives = iterate_sorted_difference(data_handler.get_sorted_derivative_iterator(),
+                                                    analysis_state.iterate_derivatives(state_dir))
+        return analysis_state.add_derivative_run(state_dir, new_derivatives)
+    except IOError:
+        print("The derivatives from the previous run could not be read or updated.")
+        analysis_state.clear_derivatives()
+        return None
+
+
+def save_incremental_state(params, analysis_state, potfile_offset):
+    analysis_state.potfile_offset = potfile_offset
+    analysis_state.analysis_settings = get_analysis_settings(params)
+    analysis_state.derivation_settings = get_derivation_settings(params)
+    analysis_state.password_count = password_count
+    analysis_state.masks = masks
+    analysis_state.literal_fragments = literal_fragments
+    analysis_state.word_extractor = word_extractor
+    if params.analyze_only or params.stream_target is not None or params.hashcat_rules:
+        analysis_state.clear_derivatives()
+    try:
+        analysis_state.save(params.state_dir, params.potfile_name)
+        print("Analysis state saved to '%s'" % params.state_dir)
+    except IOError:
+        print("There was an issue saving the analysis state.")
+
+
+def get_minimum_reported_count():
+    return max(minimum_reported_occurrences, int(password_count * minimum_reported_percentage / 100.0))
 
 
-def analyze_masks(weight_cutoff):
+def analyze_masks(weight_cutoff, hash_rate=None, time_budget=None):
     global ordered_mask_list
     print("Analyzing masks...")
-    ordered_mask_list = [(v, k) for k, v in masks.items()]
-    ordered_mask_list.sort(reverse=True)
-    mask_list = []
     mask_count_cutoff = math.ceil(float(password_count) * weight_cutoff)
+    ordered_mask_list = masktools.get_ordered_mask_counts(masks, get_minimum_reported_count(), mask_count_cutoff)
+    fragment_index = masktools.get_fragment_index(literal_fragments, masks, get_minimum_reported_count())
+    if time_budget is not None:
+        if hash_rate is not None:
+            print("Masks expected to crack the most passwords in %s at %s hashes per second will be processed." %
+                  (elapsed_time_str(0, time_budget), format_hash_rate(hash_rate)))
+            return masktools.get_mask_attack_plan(ordered_mask_list, hash_rate, time_budget, fragment_index)
+        print("A time budget needs --hash-rate to plan masks, falling back to the mask weight cutoff.")
+    mask_list = []
     print("Mask cutoff: " + str(weight_cutoff))
     print("Most common masks for " + str(mask_count_cutoff) + " passwords will be processed.")
     mask_process_password_count = 0
@@ -120,38 +391,251 @@ def analyze_masks(weight_cutoff):
             break
         mask_process_password_count += count_mask_pair[0]
         mask_list.append(count_mask_pair[1])
-    return masktools.get_mask_attack_suggestions(mask_list)
-
-
-def generate_derivatives(depth, password_length_limit):
-    for i in range(depth):
-        record_count = data_handler.working_password_count()
-        progress_prefix = "\rProcessing password set for depth " + str(i+1) + "... "
-        counter = 1
-        cursor = data_handler.get_working_password_iterator()
-        depth_start_time = time.time()
-        time_remaining = None
-        for row in cursor:
-            if counter % 128 == 0:
-                time_remaining = get_estimated_time_remaining(float(counter) / float(record_count), depth_start_time)
-            print_progress(progress_prefix, counter, record_count, time_remaining)
-            counter += 1
-            next_password = row[0]
-            if len(next_password) <= password_length_limit:
-                fresh_derivative_set = passwordtools.get_all_derivatives(row[0])
-                data_handler.stage_many_passwords(fresh_derivative_set, auto_commit=False)
-        data_handler.commit()
-        print("")
-        print("Aggregating results from depth " + str(i+1) + "...")
-        data_handler.flush_staged_passwords()
+    return masktools.get_mask_attack_suggestions(mask_list, fragment_index)
 
 
-def write_derivative_output(filename):
+def iterate_password_batches(rows, batch_size):
+    rows = iter(rows)
+    while True:
+        password_batch = [row[0] for row in islice(rows, batch_size)]
+        if len(password_batch) == 0:
+            break
+        yield password_batch
+
+
+def get_batch_deriver(password_length_limit, leet_policy, depth):
+    if prioritized_candidates is None:
+        return partial(passwordtools.get_batch_derivatives, length_limit=password_length_limit,
+                       leet_policy=leet_policy)
+    return partial(scoring.get_batch_scored_derivatives, depth=depth, length_limit=password_length_limit,
+                   leet_policy=leet_policy)
+
+
+def iterate_derivative_batches(password_batches, batch_deriver, pool=None, max_pending=1):
+    if pool is None:
+        for password_batch in password_batches:
+            yield len(password_batch), batch_deriver(password_batch)
+        return
+    pending = deque()
+    for password_batch in password_batches:
+        pending.append((len(password_batch), pool.apply_async(batch_deriver, (password_batch,))))
+        if len(pending) >= max_pending:
+            batch_size, result = pending.popleft()
+            yield batch_size, result.get()
+    while len(pending) > 0:
+        batch_size, result = pending.popleft()
+        yield batch_size, result.get()
+
+
+def build_leet_policy(max_substitutions, max_candidates, top_k):
+    substitution_weights = None
+    if top_k is not None:
+        substitution_weights = leetspeak.get_substitution_weights(word_extractor.iterate_word_variants())
+    return leetspeak.LeetPolicy(max_substitutions, max_candidates, top_k, substitution_weights)
+
+
+def create_derivation_pool(workers):
+    if workers <= 1:
+        return None
+    if prioritized_candidates is None:
+        return multiprocessing.Pool(workers)
+    return multiprocessing.Pool(workers, scoring.set_worker_scorer, (scoring.worker_scorer,))
+
+
+def generate_derivatives(depth, password_length_limit, workers=1, leet_policy=None, checkpointer=None,
+                         max_output_depth=None):
+    pool = create_derivation_pool(workers)
+    start_depth = 0
+    if checkpointer is not None and checkpointer.resuming:
+        start_depth = checkpointer.depth
     try:
-        with open(filename, "w") as outfile:
-            cursor = data_handler.get_derivative_iterator()
-            for row in cursor:
-                outfile.write(row[0] + "\n")
+        for i in range(start_depth, depth):
+            record_count = data_handler.working_password_count()
+            progress_prefix = "Processing password set for depth " + str(i+1) + "..."
+            if checkpointer is None:
+                counter = 0
+                working_rows = data_handler.get_working_password_iterator()
+            else:
+                if not checkpointer.is_resuming(i):
+                    earlier_generations = [iterate_store_passwords(rows)
+                                           for rows in data_handler.get_generation_iterators()[:-1]]
+                    checkpointer.start_depth(i, iterate_store_passwords(data_handler.get_working_password_iterator()),
+                                             iterate_store_passwords(data_handler.get_derivative_iterator()),
+                                             earlier_generations)
+                counter = checkpointer.position
+                working_rows = checkpointer.iterate_working_rows()
+            password_batches = iterate_password_batches(working_rows, derivation_batch_size)
+            with profiler.stage("generate_derivatives_depth_%d" % (i+1)) as stage, \
+                    progress.ProgressReporter("depth_%d" % (i+1), progress_prefix, record_count, counter) as reporter:
+                batch_deriver = get_batch_deriver(password_length_limit, leet_policy, i+1)
+                prioritize_depth = prioritized_candidates is not None and \
+                    (max_output_depth is None or i+1 <= max_output_depth)
+                for batch_size, fresh_derivative_set in iterate_derivative_batches(password_batches, batch_deriver,
+                                                                                   pool, workers * 2):
+                    reporter.update(batch_size, len(fresh_derivative_set))
+                    data_handler.stage_many_passwords(fresh_derivative_set, auto_commit=False)
+                    if checkpointer is not None:
+                        checkpointer.record_batch(batch_size, fresh_derivative_set)
+                    if prioritize_depth:
+                        prioritized_candidates.add_many(fresh_derivative_set.items())
+                data_handler.commit()
+                stage.items_in = reporter.completed - reporter.start_completed
+                stage.items_out = reporter.derivatives
+            print("Aggregating results from depth " + str(i+1) + "...")
+            with profiler.stage("flush_staged_passwords_depth_%d" % (i+1)) as stage:
+                data_handler.flush_staged_passwords()
+                stage.items_out = data_handler.generation_counts[-1]
+            print("Depth %d produced %d new candidates." % (i+1, data_handler.generation_counts[-1]))
+            if data_handler.generation_counts[-1] == 0:
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def stream_derivatives(params, stream_output, leet_policy):
+    candidate_stream = streaming.CandidateStream(stream_output, params.stream_capacity,
+                                                 params.stream_false_positive_rate, params.output_max_depth)
+    pool = create_derivation_pool(params.workers)
+    frontier = streaming.FrontierFile(params.temp_dir)
+    next_frontier = None
+    try:
+        print("Streaming potfile passwords...")
+        candidate_stream.add_many(iterate_store_passwords(data_handler.get_working_password_iterator()), 0, frontier)
+        frontier.finish()
+        for i in range(params.depth):
+            next_frontier = None
+            if i + 1 < params.depth:
+                next_frontier = streaming.FrontierFile(params.temp_dir)
+            progress_prefix = "Streaming password set for depth " + str(i+1) + "..."
+            password_batches = iterate_password_batches(frontier.iterate_rows(), derivation_batch_size)
+            with profiler.stage("stream_derivatives_depth_%d" % (i+1)) as stage, \
+                    progress.ProgressReporter("depth_%d" % (i+1), progress_prefix, frontier.count) as reporter:
+                batch_deriver = get_batch_deriver(params.derivative_base_length_limit, leet_policy, i+1)
+                for batch_size, fresh_derivative_set in iterate_derivative_batches(password_batches, batch_deriver,
+                                                                                   pool, params.workers * 2):
+                    reporter.update(batch_size, candidate_stream.add_many(fresh_derivative_set, i+1, next_frontier))
+                candidate_stream.flush()
+                stage.items_in = reporter.completed
+                stage.items_out = reporter.derivatives
+            frontier.remove()
+            frontier, next_frontier = next_frontier, None
+            if frontier is None or frontier.count == 0:
+                break
+            frontier.finish()
+    except BrokenPipeError:
+        print("The stream reader closed the pipe, stopping derivative generation.")
+        candidate_stream.discard_output()
+    finally:
+        for remaining_frontier in (frontier, next_frontier):
+            if remaining_frontier is not None:
+                remaining_frontier.remove()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        candidate_stream.close()
+    return candidate_stream.emitted_count
+
+
+def write_hashcat_rules(params, leet_policy):
+    rule_counts = Counter()
+    derivative_estimate = 0
+    pool = create_derivation_pool(params.workers)
+    try:
+        password_batches = iterate_password_batches(data_handler.get_working_password_iterator(),
+                                                    derivation_batch_size)
+        batch_counter = partial(hashcatrules.count_batch_rules, length_limit=params.derivative_base_length_limit,
+                                leet_policy=leet_policy)
+        with progress.ProgressReporter("rules", "Extracting hashcat rules...",
+                                       data_handler.working_password_count()) as reporter:
+            for batch_size, (batch_rule_counts, batch_derivative_estimate) in \
+                    iterate_derivative_batches(password_batches, batch_counter, pool, params.workers * 2):
+                rule_counts.update(batch_rule_counts)
+                derivative_estimate += batch_derivative_estimate
+                reporter.update(batch_size, batch_derivative_estimate)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    word_count = 0
+    rule_count = 0
+    try:
+        with open(params.wordlist_output_name, "w", buffering=output_buffer_size) as outfile:
+            for password_block in iterate_password_batches(data_handler.get_working_password_iterator(),
+                                                           output_block_size):
+                outfile.write("\n".join(password_block))
+                outfile.write("\n")
+                word_count += len(password_block)
+        rule_count = hashcatrules.write_rule_file(params.rule_output_name, rule_counts)
+    except IOError:
+        print("There was an issue writing the hashcat rules output.")
+    return word_count, rule_count, derivative_estimate
+
+
+def iterate_store_passwords(rows):
+    for row in rows:
+        yield row[0]
+
+
+def create_checkpointer(params):
+    settings = [analysisstate.get_file_signature(params.potfile_name), get_analysis_settings(params),
+                get_derivation_settings(params)]
+    checkpoint_interval = params.checkpoint_interval
+    if checkpoint_interval is None:
+        checkpoint_interval = checkpoint.default_checkpoint_interval
+    checkpointer = checkpoint.Checkpointer(params.checkpoint_dir, settings, checkpoint_interval)
+    if params.resume:
+        checkpoint_state = checkpoint.load_checkpoint(params.checkpoint_dir)
+        if checkpointer.matches(checkpoint_state):
+            print("Resuming from the checkpoint in '%s' at depth %d..." % (params.checkpoint_dir,
+                                                                         checkpoint_state["depth"] + 1))
+            checkpointer.resume(checkpoint_state, data_handler)
+        else:
+            print("No usable checkpoint found in '%s', starting from the beginning." % params.checkpoint_dir)
+    return checkpointer
+
+
+def start_prioritization(params):
+    global prioritized_candidates
+    scoring.set_worker_scorer(scoring.CandidateScorer(masks, word_extractor.extracted_word_count))
+    run_size = scoring.default_sort_run_size
+    if params.memory_budget is not None:
+        run_size = max(data_handler.reserve_memory(params.memory_budget // 3) // scoring.sort_entry_overhead,
+                       potfile_block_size)
+    prioritized_candidates = scoring.PrioritizedCandidates(run_size, params.temp_dir)
+    working_rows = data_handler.get_working_password_iterator()
+    for password_block in iterate_password_batches(working_rows, potfile_block_size):
+        prioritized_candidates.add_many(scoring.worker_scorer.score_many(password_block, scoring.EDIT_ORIGINAL, 0))
+
+
+def iterate_derivative_rows(max_candidates=None):
+    if prioritized_candidates is None:
+        return data_handler.get_derivative_iterator()
+    return iterate_collection_as_tuples(prioritized_candidates.iterate_ordered(max_candidates))
+
+
+def write_derivative_output(filename, max_candidates=None, derivative_rows=None):
+    try:
+        with open(filename, "w", buffering=output_buffer_size) as outfile:
+            if derivative_rows is None:
+                derivative_rows = iterate_derivative_rows(max_candidates)
+            for password_block in iterate_password_batches(derivative_rows, output_block_size):
+                outfile.write("\n".join(password_block))
+                outfile.write("\n")
+    except IOError:
+        print("There was an issue writing the derivatives output.")
+
+
+def write_incremental_derivative_output(filename, analysis_state, state_dir, new_run_path):
+    if new_run_path is None or not analysis_state.matches_derivative_output(filename):
+        write_derivative_output(filename, derivative_rows=iterate_collection_as_tuples(
+            analysis_state.iterate_derivatives(state_dir)))
+        return
+    try:
+        with open(new_run_path, "r", encoding="utf-8", newline="\n") as run_file, \
+                open(filename, "a", buffering=output_buffer_size) as outfile:
+            shutil.copyfileobj(run_file, outfile, output_buffer_size)
     except IOError:
         print("There was an issue writing the derivatives output.")
 
@@ -163,10 +647,22 @@ def backup_potfile(potfile_name, backup_name):
         print("There was a problem producing the previous used password file")
 
 
-def write_maskfile_output(filename, mask_attack_list):
+def format_hash_rate(hash_rate):
+    return "%.0f" % hash_rate
+
+
+def get_mask_runtime(mask, hash_rate):
+    return masktools.get_mask_keyspace(mask) / hash_rate
+
+
+def write_maskfile_output(filename, mask_attack_list, hash_rate=None):
     try:
         with open(filename, "w") as outfile:
             for mask in mask_attack_list:
+                if hash_rate is not None:
+                    outfile.write("# %d candidates, %s at %s hashes per second\n" %
+                                  (masktools.get_mask_keyspace(mask),
+                                   elapsed_time_str(0, get_mask_runtime(mask, hash_rate)), format_hash_rate(hash_rate)))
                 outfile.write(mask + "\n")
     except IOError:
         print("There was an issue writing the mask attack file")
@@ -178,10 +674,10 @@ def write_analysis_output(filename):
             outfile.write("Common words in passwords:\n")
             for word_tuple in word_extractor.get_ordered_common_words():
                 occurrences = word_tuple[0]
-                if occurrences < 2:
+                if occurrences < minimum_reported_occurrences:
                     break
                 pct = (float(occurrences) / float(password_count)) * 100.00
-                if pct < 0.01:
+                if pct < minimum_reported_percentage:
                     break
                 word = word_tuple[1]
                 variants = word_extractor.get_variants(word)
@@ -189,10 +685,10 @@ def write_analysis_output(filename):
             outfile.write("\nCommon password masks:\n")
             for mask_tuple in ordered_mask_list:
                 occurrences = mask_tuple[0]
-                if occurrences < 2:
+                if occurrences < minimum_reported_occurrences:
                     break
                 pct = (float(occurrences) / float(password_count)) * 100.00
-                if pct < 0.01:
+                if pct < minimum_reported_percentage:
                     break
                 mask = mask_tuple[1]
                 outfile.write("%s (%.2f%%) - %s\n" % (occurrences, pct, mask))
@@ -200,6 +696,24 @@ def write_analysis_output(filename):
         print("There was an issue writing the analysis file")
 
 
+def print_pipeline_stats(params):
+    print("* * *")
+    for line in profiler.get_summary_lines():
+        print(line)
+    if params.stats_json_name is not None:
+        try:
+            profiler.write_json(params.stats_json_name)
+            print("Pipeline stats saved to '%s'" % params.stats_json_name)
+        except IOError:
+            print("There was an issue writing the pipeline stats file")
+    if params.profile_name is not None:
+        try:
+            profiler.write_profile()
+            print("Derivation profile saved to '%s'" % params.profile_name)
+        except IOError:
+            print("There was an issue writing the derivation profile")
+
+
 def elapsed_time_str(start_time, end_time):
     process_time = round(end_time - start_time, 2)
     process_time_string = str(timedelta(seconds=process_time))
@@ -221,29 +735,133 @@ def main():
         print_usage()
         exit()
 
+    if params.command == parameters.index_command:
+        index_potfile(params)
+        exit()
+
+    if params.profile_name is not None:
+        profiler.enable_profile(params.profile_name)
+    stream_stdout = None
+    if params.stream_target == streaming.stdout_target and not params.analyze_only:
+        stream_stdout = sys.stdout
+        sys.stdout = sys.stderr
+    word_extractor.max_variants = params.max_word_variants
+
     unique_derivatives_computed = 0
+    rule_output_counts = None
     start_time = time.time()
-    with database.SqliteDataHandler() as data_handler:
-        if params.previous_passwords is not None and not params.analyze_only:
-            import_password_omissions(params.previous_passwords)
-        import_potfile(params.potfile_name)
-        mask_attack_suggestions = analyze_masks(params.mask_weight_cutoff)
+    with database.SqliteDataHandler(params.dedup_backend, params.temp_dir, params.memory_budget,
+                                    params.output_max_depth is not None) as data_handler:
+        omissions_requested = params.previous_passwords is not None or params.omission_filter_name is not None
+        if omissions_requested and not params.analyze_only:
+            with profiler.stage("import_password_omissions") as stage:
+                import_password_omissions(params.previous_passwords, params.omission_filter_name,
+                                          params.omission_false_positive_rate, params.exact_omissions)
+                stage.items_out = omission_count
+        previous_state = None
+        analysis_state = None
+        if params.incremental:
+            previous_state = load_incremental_state(params)
+            analysis_state = previous_state if previous_state is not None else analysisstate.AnalysisState()
+        start_offset = 0 if previous_state is None else previous_state.potfile_offset
+        potfile_cache = None
+        if not params.incremental:
+            potfile_cache = load_potfile_cache(params)
+        with profiler.stage("import_potfile") as stage:
+            previous_password_count = password_count
+            if potfile_cache is not None:
+                potfile_offset = import_potfile_cache(potfile_cache, not params.analyze_only)
+                potfile_cache.close()
+            elif params.analyze_only and params.workers > 1:
+                potfile_offset = import_potfile_sharded(params.potfile_name, params.workers, start_offset,
+                                                        not params.incremental, params.hash_fields)
+            else:
+                potfile_offset = import_potfile(params.potfile_name, start_offset, not params.incremental,
+                                                params.hash_fields)
+            stage.items_out = password_count - previous_password_count
+        with profiler.stage("analyze_masks", len(masks)) as stage:
+            mask_attack_suggestions = analyze_masks(params.mask_weight_cutoff, params.hash_rate, params.time_budget)
+            stage.items_out = len(mask_attack_suggestions)
         if not params.analyze_only:
-            data_handler.flush_staged_passwords()
-            generate_derivatives(params.depth, params.derivative_base_length_limit)
+            with profiler.stage("flush_staged_passwords"):
+                data_handler.flush_staged_passwords()
+            leet_policy = build_leet_policy(params.leet_max_substitutions, params.leet_max_candidates,
+                                            params.leet_top_k)
+        if not params.analyze_only and params.hashcat_rules:
+            with profiler.stage("write_hashcat_rules") as stage, profiler.profiled():
+                rule_output_counts = write_hashcat_rules(params, leet_policy)
+                stage.items_out = rule_output_counts[1]
+        elif not params.analyze_only and params.stream_target is None:
+            checkpointer = None
+            new_run_path = None
+            if params.prioritize:
+                if params.checkpoint_interval is not None or params.resume:
+                    print("Checkpoints are not supported while prioritizing, derivatives will not be checkpointed.")
+                with profiler.stage("start_prioritization"):
+                    start_prioritization(params)
+            elif params.checkpoint_interval is not None or params.resume:
+                checkpointer = create_checkpointer(params)
+            with profiler.profiled():
+                generate_derivatives(params.depth, params.derivative_base_length_limit, params.workers, leet_policy,
+                                     checkpointer, params.output_max_depth)
+            if checkpointer is not None:
+                checkpointer.remove()
+            if params.output_max_depth is not None:
+                data_handler.discard_generations_after(params.output_max_depth)
             unique_derivatives_computed = data_handler.derivative_count()
+            if analysis_state is not None:
+                with profiler.stage("record_incremental_derivatives"):
+                    new_run_path = record_incremental_derivatives(analysis_state, params.state_dir)
+                if analysis_state.has_derivatives:
+                    unique_derivatives_computed = analysis_state.derivative_count
         print("Outputting results to disk...")
+        if not params.analyze_only and params.stream_target is None and not params.hashcat_rules:
+            with profiler.stage("write_derivative_output", unique_derivatives_computed):
+                if analysis_state is not None and analysis_state.has_derivatives and prioritized_candidates is None:
+                    write_incremental_derivative_output(params.derivative_output_name, analysis_state,
+                                                        params.state_dir, new_run_path)
+                else:
+                    write_derivative_output(params.derivative_output_name, params.max_candidates)
+                if analysis_state is not None:
+                    analysis_state.set_derivative_output(params.derivative_output_name)
+            if prioritized_candidates is not None:
+                prioritized_candidates.close()
         if not params.analyze_only:
-            write_derivative_output(params.derivative_output_name)
             backup_potfile(params.potfile_name, params.potfile_backup_name)
-        write_maskfile_output(params.maskfile_output_name, mask_attack_suggestions)
-        write_analysis_output(params.analysis_output_name)
+        with profiler.stage("write_maskfile_output", len(mask_attack_suggestions)):
+            write_maskfile_output(params.maskfile_output_name, mask_attack_suggestions, params.hash_rate)
+        with profiler.stage("write_analysis_output"):
+            write_analysis_output(params.analysis_output_name)
+        if not params.analyze_only and params.stream_target is not None:
+            if params.prioritize:
+                print("Streamed derivatives are written as they are generated and cannot be prioritized.")
+            if params.checkpoint_interval is not None or params.resume:
+                print("Checkpoints are not supported while streaming, derivatives will not be checkpointed.")
+            try:
+                stream_output = streaming.open_stream_output(params.stream_target, stream_stdout)
+                with profiler.profiled():
+                    unique_derivatives_computed = stream_derivatives(params, stream_output, leet_policy)
+            except IOError:
+                print("The stream output '%s' could not be opened." % params.stream_target)
+        if params.incremental and potfile_offset is not None:
+            save_incremental_state(params, analysis_state, potfile_offset)
     end_time = time.time()
 
     print("* * *")
     if params.analyze_only:
         print("Results saved to '%s' '%s'" % (params.maskfile_output_name,
                                               params.analysis_output_name))
+    elif params.hashcat_rules:
+        print("Results saved to '%s' '%s' '%s' '%s'" % (params.rule_output_name,
+                                                        params.wordlist_output_name,
+                                                        params.maskfile_output_name,
+                                                        params.analysis_output_name))
+        print("Potfile backup saved to '%s'" % params.potfile_backup_name)
+    elif params.stream_target is not None:
+        print("Results saved to '%s' '%s'" % (params.maskfile_output_name,
+                                              params.analysis_output_name))
+        print("Derivatives streamed to '%s'" % params.stream_target)
+        print("Potfile backup saved to '%s'" % params.potfile_backup_name)
     else:
         print("Results saved to '%s' '%s' '%s'" % (params.derivative_output_name,
                                                    params.maskfile_output_name,
@@ -253,9 +871,26 @@ def main():
     print("Processing took %s" % elapsed_time_str(start_time, end_time))
     print("* * *")
     print("Passwords processed from potfile: %s" % str(password_count))
-    print("Unique derivatives computed: %s" % str(unique_derivatives_computed))
+    if rule_output_counts is not None:
+        word_count, rule_count, derivative_estimate = rule_output_counts
+        print("Base words written: %s" % str(word_count))
+        print("Hashcat rules written: %s" % str(rule_count))
+        print("Derivatives generated at depth 1 before dedup: %s" % str(derivative_estimate))
+        print("Estimated hashcat keyspace at depth %d: %s" % (params.depth, str(
+            hashcatrules.get_rule_keyspace(word_count, rule_count, params.depth))))
+        if params.depth > 1:
+            print("Stack the rule file %d times with -r to reach depth %d." % (params.depth, params.depth))
+    else:
+        print("Unique derivatives computed: %s" % str(unique_derivatives_computed))
+    if params.max_candidates is not None and params.stream_target is None and not params.analyze_only:
+        print("Highest scoring derivatives written: %s" % str(min(params.max_candidates, unique_derivatives_computed)))
     print("Unique Masks discovered: %s" % str(len(masks)))
     print("%s focused attack masks created for .hcmask file" % str(len(mask_attack_suggestions)))
+    if params.hash_rate is not None:
+        print("Estimated mask attack runtime: %s" % elapsed_time_str(
+            0, sum(get_mask_runtime(mask, params.hash_rate) for mask in mask_attack_suggestions)))
+    if params.profile_name is not None or params.stats_json_name is not None:
+        print_pipeline_stats(params)
 
 
 if __name__ == "__main__":
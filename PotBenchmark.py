@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+import getopt
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import sys
+import tempfile
+import time
+from functools import partial
+from analyzertools import passwordtools, masktools, leetspeak, database, synthetic, profiling
+
+default_size = 20000
+default_derivative_sample = 500
+default_end_to_end_size = 2000
+default_depth_two_size = 5
+default_regression_threshold = 0.10
+default_word_block_size = 4096
+result_poll_interval = 1.0
+
+
+def print_usage():
+    print("""usage: %s
+    [-s, --size SIZE]                           Number of synthetic passwords per benchmark (default %d)
+    [--lengths MIN-MAX]                         Synthetic password length range (default %d-%d)
+    [--charset LOWER:UPPER:DIGIT:SPECIAL]       Synthetic character class weights (default %s)
+    [--derivative-sample SIZE]                  Number of passwords used by derivative benchmarks (default %d)
+    [--end-to-end-size SIZE]                    Potfile size for the depth 1 end-to-end run (default %d)
+    [--depth-two-size SIZE]                     Potfile size for the depth 2 end-to-end run (default %d)
+    [--only NAME[,NAME...]]                     Only run benchmarks whose name starts with one of these prefixes
+    [--save RESULTS_FILE]                       Save the results as JSON
+    [--baseline RESULTS_FILE]                   Compare the results against a previously saved JSON file
+    [--threshold FRACTION]                      Relative change reported as a regression (default %.2f)
+    [--fail-on-regression]                      Exit with status 1 when a regression is found
+    [-h, --help]                                Show this help output""" % (
+        sys.argv[0], default_size, synthetic.default_length_range[0], synthetic.default_length_range[1],
+        ":".join(str(weight) for weight in synthetic.default_charset_weights), default_derivative_sample,
+        default_end_to_end_size, default_depth_two_size, default_regression_threshold))
+
+
+class BenchmarkParameters:
+    unix_options = "hs:"
+    gnu_options = ["help", "size=", "lengths=", "charset=", "derivative-sample=", "end-to-end-size=",
+                   "depth-two-size=", "only=", "save=", "baseline=", "threshold=", "fail-on-regression"]
+
+    def __init__(self, argument_input):
+        self.display_help = False
+        self.size = default_size
+        self.length_range = synthetic.default_length_range
+        self.charset_weights = synthetic.default_charset_weights
+        self.derivative_sample = default_derivative_sample
+        self.end_to_end_size = default_end_to_end_size
+        self.depth_two_size = default_depth_two_size
+        self.only = None
+        self.results_name = None
+        self.baseline_name = None
+        self.threshold = default_regression_threshold
+        self.fail_on_regression = False
+        arguments, values = getopt.getopt(argument_input[1:], self.unix_options, self.gnu_options)
+        for current_argument, current_value in arguments:
+            if current_argument in ("-h", "--help"):
+                self.display_help = True
+            elif current_argument in ("-s", "--size"):
+                self.size = max(int(current_value), 1)
+            elif current_argument == "--lengths":
+                self.length_range = synthetic.parse_length_range(current_value)
+            elif current_argument == "--charset":
+                self.charset_weights = synthetic.parse_charset_weights(current_value)
+            elif current_argument == "--derivative-sample":
+                self.derivative_sample = max(int(current_value), 1)
+            elif current_argument == "--end-to-end-size":
+                self.end_to_end_size = max(int(current_value), 1)
+            elif current_argument == "--depth-two-size":
+                self.depth_two_size = max(int(current_value), 1)
+            elif current_argument == "--only":
+                self.only = tuple(current_value.split(","))
+            elif current_argument == "--save":
+                self.results_name = current_value
+            elif current_argument == "--baseline":
+                self.baseline_name = current_value
+            elif current_argument == "--threshold":
+                self.threshold = float(current_value)
+            elif current_argument == "--fail-on-regression":
+                self.fail_on_regression = True
+
+    def describe(self):
+        return {"size": self.size,
+                "length_range": list(self.length_range),
+                "charset_weights": list(self.charset_weights),
+                "derivative_sample": self.derivative_sample,
+                "end_to_end_size": self.end_to_end_size,
+                "depth_two_size": self.depth_two_size}
+
+
+def bench_get_mask(passwords):
+    for password in passwords:
+        masktools.get_mask(password)
+    return len(passwords), 0
+
+
+def bench_count_mask_codes(passwords):
+    masktools.count_mask_codes(passwords)
+    return len(passwords), 0
+
+
+def bench_count_literal_fragments(passwords):
+    fragment_counter = masktools.count_literal_fragments(passwords)
+    return len(passwords), len(fragment_counter)
+
+
+def bench_mask_attack_suggestions(passwords):
+    mask_list = list(set("".join(masktools.get_mask(password)) for password in passwords))
+    suggestions = masktools.get_mask_attack_suggestions(mask_list)
+    return len(mask_list), len(suggestions)
+
+
+def bench_derivatives(derivative_function, passwords):
+    derivative_count = 0
+    for password in passwords:
+        derivative_count += len(derivative_function(password))
+    return len(passwords), derivative_count
+
+
+def bench_leet_permutations(passwords):
+    derivative_count = 0
+    for password in passwords:
+        for _ in leetspeak.iterate_leet_permutations(password):
+            derivative_count += 1
+    return len(passwords), derivative_count
+
+
+def bench_word_extractor(passwords):
+    word_extractor = passwordtools.WordExtractor()
+    for password in passwords:
+        word_extractor.extract(password)
+    return len(passwords), 0
+
+
+def bench_word_extractor_many(passwords):
+    word_extractor = passwordtools.WordExtractor()
+    for i in range(0, len(passwords), default_word_block_size):
+        word_extractor.extract_many(passwords[i:i + default_word_block_size])
+    return len(passwords), 0
+
+
+def bench_data_handler(dedup_backend, passwords):
+    derivative_count = 0
+    with database.SqliteDataHandler(dedup_backend) as data_handler:
+        for password in passwords:
+            derivatives = passwordtools.get_all_derivatives(password)
+            derivative_count += len(derivatives)
+            data_handler.stage_many_passwords(derivatives, auto_commit=False)
+        data_handler.commit()
+        data_handler.flush_staged_passwords()
+    return len(passwords), derivative_count
+
+
+def bench_end_to_end(depth, extra_arguments, passwords):
+    import PotAnalyzer
+    original_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="potbenchmark_") as work_dir:
+        potfile_name = os.path.join(work_dir, "bench.potfile")
+        synthetic.write_potfile(potfile_name, passwords)
+        os.chdir(work_dir)
+        sys.argv = ["PotAnalyzer.py", potfile_name, "-d", str(depth)] + list(extra_arguments)
+        sys.stdout = open(os.devnull, "w")
+        try:
+            PotAnalyzer.main()
+        finally:
+            sys.stdout.close()
+            sys.stdout = sys.__stdout__
+            os.chdir(original_dir)
+        derivative_count = 0
+        with open(os.path.join(work_dir, "derivatives.txt"), "rb") as derivatives:
+            for _ in derivatives:
+                derivative_count += 1
+    return len(passwords), derivative_count
+
+
+def get_benchmarks(params):
+    derivative_sample = min(params.derivative_sample, params.size)
+    return [("masktools.get_mask", bench_get_mask, params.size),
+            ("masktools.count_mask_codes", bench_count_mask_codes, params.size),
+            ("masktools.count_literal_fragments", bench_count_literal_fragments, params.size),
+            ("masktools.get_mask_attack_suggestions", bench_mask_attack_suggestions, params.size),
+            ("passwordtools.get_mask_derivatives", partial(bench_derivatives, passwordtools.get_mask_derivatives),
+             derivative_sample),
+            ("passwordtools.get_add_derivatives", partial(bench_derivatives, passwordtools.get_add_derivatives),
+             derivative_sample),
+            ("passwordtools.get_remove_derivatives", partial(bench_derivatives, passwordtools.get_remove_derivatives),
+             derivative_sample),
+            ("passwordtools.get_leet_derivatives", partial(bench_derivatives, passwordtools.get_leet_derivatives),
+             derivative_sample),
+            ("passwordtools.get_all_derivatives", partial(bench_derivatives, passwordtools.get_all_derivatives),
+             derivative_sample),
+            ("leetspeak.iterate_leet_permutations", bench_leet_permutations, derivative_sample),
+            ("passwordtools.WordExtractor.extract", bench_word_extractor, params.size),
+            ("passwordtools.WordExtractor.extract_many", bench_word_extractor_many, params.size),
+            ("database.SqliteDataHandler.sqlite", partial(bench_data_handler, "sqlite"), derivative_sample),
+            ("database.SqliteDataHandler.hashset", partial(bench_data_handler, "hashset"), derivative_sample),
+            ("database.SqliteDataHandler.spill", partial(bench_data_handler, "spill"), derivative_sample),
+            ("PotAnalyzer.main.depth1", partial(bench_end_to_end, 1, ()), params.end_to_end_size),
+            ("PotAnalyzer.main.depth2", partial(bench_end_to_end, 2, ()), params.depth_two_size)]
+
+
+def _run_in_child(bench, passwords, result_queue):
+    start_time = time.perf_counter()
+    start_cpu_time = time.process_time()
+    items, derivatives = bench(passwords)
+    seconds = time.perf_counter() - start_time
+    cpu_seconds = time.process_time() - start_cpu_time
+    peak_rss_kb = profiling.get_peak_rss_kb()
+    result_queue.put((seconds, cpu_seconds, items, derivatives, peak_rss_kb))
+
+
+def run_benchmark(bench, passwords):
+    result_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_in_child, args=(bench, passwords, result_queue))
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = result_queue.get(timeout=result_poll_interval)
+        except queue.Empty:
+            if not process.is_alive():
+                break
+    if result is None:
+        # The child may have exited right after queueing its result
+        try:
+            result = result_queue.get(timeout=result_poll_interval)
+        except queue.Empty:
+            pass
+    process.join()
+    if result is None:
+        return None
+    seconds, cpu_seconds, items, derivatives, peak_rss_kb = result
+    return {"seconds": seconds,
+            "cpu_seconds": cpu_seconds,
+            "items": items,
+            "items_per_second": items / seconds if seconds > 0 else 0.0,
+            "derivatives": derivatives,
+            "derivatives_per_second": derivatives / seconds if seconds > 0 else 0.0,
+            "peak_rss_kb": peak_rss_kb}
+
+
+def print_result(name, result):
+    print("%-42s %12.0f items/s %14.0f derivatives/s %10s KB peak RSS" % (
+        name, result["items_per_second"], result["derivatives_per_second"],
+        "-" if result["peak_rss_kb"] is None else str(result["peak_rss_kb"])))
+
+
+def relative_change(current, previous):
+    if previous == 0:
+        return 0.0
+    return (current - previous) / previous
+
+
+def compare_results(results, baseline, threshold):
+    regressions = []
+    print("* * *")
+    print("Comparison against baseline (positive throughput and negative memory changes are improvements):")
+    for name, result in results.items():
+        if name not in baseline:
+            print("%-42s new benchmark" % name)
+            continue
+        previous = baseline[name]
+        changes = []
+        for metric, higher_is_better in (("items_per_second", True), ("derivatives_per_second", True),
+                                         ("peak_rss_kb", False)):
+            if result[metric] is None or previous[metric] is None:
+                continue
+            change = relative_change(result[metric], previous[metric])
+            changes.append("%s %+.1f%%" % (metric, change * 100.0))
+            if (higher_is_better and change < -threshold) or (not higher_is_better and change > threshold):
+                regressions.append((name, metric, change))
+        print("%-42s %s" % (name, ", ".join(changes)))
+    print("* * *")
+    if len(regressions) == 0:
+        print("No regressions beyond %.0f%% found." % (threshold * 100.0))
+    for name, metric, change in regressions:
+        print("REGRESSION %s %s %+.1f%%" % (name, metric, change * 100.0))
+    return regressions
+
+
+def main():
+    params = BenchmarkParameters(sys.argv)
+    if params.display_help:
+        print_usage()
+        exit()
+
+    generator = synthetic.PasswordGenerator(params.length_range, params.charset_weights)
+    largest_input = max(params.size, params.end_to_end_size, params.depth_two_size)
+    passwords = generator.generate(largest_input)
+    results = {}
+    failures = []
+    for name, bench, input_size in get_benchmarks(params):
+        if params.only is not None and not name.startswith(params.only):
+            continue
+        result = run_benchmark(bench, passwords[:input_size])
+        if result is None:
+            print("%-42s FAILED" % name)
+            failures.append(name)
+            continue
+        results[name] = result
+        print_result(name, result)
+
+    if params.results_name is not None:
+        with open(params.results_name, "w") as results_file:
+            json.dump({"python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "parameters": params.describe(),
+                       "results": results}, results_file, indent=2, sort_keys=True)
+        print("Results saved to '%s'" % params.results_name)
+
+    if params.baseline_name is not None:
+        with open(params.baseline_name, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("parameters") != params.describe():
+            print("Warning: the baseline was recorded with different benchmark parameters.")
+        regressions = compare_results(results, baseline.get("results", {}), params.threshold)
+        if params.fail_on_regression and len(regressions) > 0:
+            exit(1)
+    if len(failures) > 0:
+        print("%d benchmarks failed: %s" % (len(failures), ", ".join(failures)))
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
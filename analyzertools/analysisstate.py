@@ -0,0 +1,179 @@
+import hashlib
+import heapq
+import os
+import pickle
+import re
+from collections import Counter
+from analyzertools import dedupstore, masktools, scoring
+
+state_version = 9
+state_filename = "analysis.pickle"
+derivative_run_filename = "derivatives_%d.txt"
+derivative_run_pattern = re.compile(r"^derivatives_\d+\.txt$")
+fingerprint_size = 65536
+
+
+def get_potfile_fingerprint(filename, offset):
+    fingerprint_start = max(offset - fingerprint_size, 0)
+    with open(filename, "rb") as potfile:
+        potfile.seek(fingerprint_start)
+        return hashlib.blake2b(potfile.read(offset - fingerprint_start)).hexdigest()
+
+
+def get_file_signature(filename):
+    if filename is None or not os.path.exists(filename):
+        return None
+    file_stat = os.stat(filename)
+    return os.path.abspath(filename), file_stat.st_size, file_stat.st_mtime
+
+
+class AnalysisState:
+    def __init__(self):
+        self.version = state_version
+        self.potfile_offset = 0
+        self.potfile_fingerprint = None
+        self.analysis_settings = None
+        self.derivation_settings = None
+        self.password_count = 0
+        self.masks = Counter()
+        self.literal_fragments = masktools.FragmentCounter()
+        self.word_extractor = None
+        self.has_derivatives = False
+        self.derivatives_scored = False
+        self.derivative_runs = []
+        self.derivative_count = 0
+        self.derivative_output_signature = None
+        self.next_run_index = 0
+
+    def matches_potfile(self, potfile_name):
+        try:
+            if os.path.getsize(potfile_name) < self.potfile_offset:
+                return False
+            return get_potfile_fingerprint(potfile_name, self.potfile_offset) == self.potfile_fingerprint
+        except IOError:
+            return False
+
+    def matches_settings(self, analysis_settings, derivation_settings=None):
+        if self.analysis_settings != analysis_settings:
+            return False
+        if derivation_settings is None:
+            return True
+        return self.has_derivatives and self.derivation_settings == derivation_settings
+
+    def _merge_runs(self, state_dir, runs):
+        run_paths = [os.path.join(state_dir, run_name) for run_name, run_count in runs]
+        # Plain runs never share a derivative, scored runs repeat a derivative whenever its edit score improved
+        if self.derivatives_scored:
+            return scoring.merge_best_scores([scoring.iterate_scored_run(path) for path in run_paths])
+        return heapq.merge(*[dedupstore.iterate_run(path) for path in run_paths])
+
+    def iterate_derivatives(self, state_dir):
+        if self.derivatives_scored:
+            return (derivative for derivative, edit_score in self.iterate_scored_derivatives(state_dir))
+        return self._merge_runs(state_dir, self.derivative_runs)
+
+    def iterate_scored_derivatives(self, state_dir):
+        return self._merge_runs(state_dir, self.derivative_runs)
+
+    def add_derivative_run(self, state_dir, sorted_derivatives):
+        os.makedirs(state_dir, exist_ok=True)
+        run_name = self._get_next_run_name(state_dir)
+        run_count = _write_run(os.path.join(state_dir, run_name), sorted_derivatives)
+        self.derivative_runs.append((run_name, run_count))
+        self.derivative_count += run_count
+        self.has_derivatives = True
+        return os.path.join(state_dir, run_name)
+
+    def add_scored_derivative_run(self, state_dir, sorted_edit_scores):
+        os.makedirs(state_dir, exist_ok=True)
+        self.derivatives_scored = True
+        run_name = self._get_next_run_name(state_dir)
+        run_count = scoring.write_scored_file(os.path.join(state_dir, run_name),
+                                              self._iterate_scored_updates(state_dir, sorted_edit_scores))
+        self.derivative_runs.append((run_name, run_count))
+        self.has_derivatives = True
+
+    def _iterate_scored_updates(self, state_dir, sorted_edit_scores):
+        # Only derivatives that are new or whose edit score improved are written, so the runs stay append only
+        previous_scores = self.iterate_scored_derivatives(state_dir)
+        previous = next(previous_scores, None)
+        for derivative, edit_score in sorted_edit_scores:
+            while previous is not None and previous[0] < derivative:
+                previous = next(previous_scores, None)
+            if previous is None or previous[0] != derivative:
+                self.derivative_count += 1
+                yield edit_score, derivative
+            elif edit_score > previous[1]:
+                yield edit_score, derivative
+
+    def _get_next_run_name(self, state_dir):
+        # Never overwrite a run that the saved state may still reference
+        run_name = derivative_run_filename % self.next_run_index
+        while os.path.exists(os.path.join(state_dir, run_name)):
+            self.next_run_index += 1
+            run_name = derivative_run_filename % self.next_run_index
+        self.next_run_index += 1
+        return run_name
+
+    def clear_derivatives(self):
+        self.has_derivatives = False
+        self.derivatives_scored = False
+        self.derivative_runs = []
+        self.derivative_count = 0
+        self.derivative_output_signature = None
+
+    def set_derivative_output(self, filename):
+        self.derivative_output_signature = get_file_signature(filename)
+
+    def matches_derivative_output(self, filename):
+        return self.derivative_output_signature is not None and \
+            get_file_signature(filename) == self.derivative_output_signature
+
+    def compact_derivative_runs(self, state_dir):
+        # Merge the newest runs while they are at least half the size of the run before them, which keeps the
+        # run count logarithmic without rewriting the whole derivative set on every incremental run
+        while len(self.derivative_runs) > 1 and \
+                self.derivative_runs[-1][1] * 2 >= self.derivative_runs[-2][1]:
+            merged_derivatives = self._merge_runs(state_dir, self.derivative_runs[-2:])
+            run_name = self._get_next_run_name(state_dir)
+            if self.derivatives_scored:
+                run_count = scoring.write_scored_file(os.path.join(state_dir, run_name), (
+                    (edit_score, derivative) for derivative, edit_score in merged_derivatives))
+            else:
+                run_count = _write_run(os.path.join(state_dir, run_name), merged_derivatives)
+            self.derivative_runs[-2:] = [(run_name, run_count)]
+
+    def save(self, state_dir, potfile_name):
+        os.makedirs(state_dir, exist_ok=True)
+        self.potfile_fingerprint = get_potfile_fingerprint(potfile_name, self.potfile_offset)
+        self.compact_derivative_runs(state_dir)
+        temporary_path = os.path.join(state_dir, state_filename + ".tmp")
+        with open(temporary_path, "wb") as state_file:
+            pickle.dump(self, state_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, os.path.join(state_dir, state_filename))
+        # Runs are only removed once the new state no longer references them
+        live_runs = set(run_name for run_name, _ in self.derivative_runs)
+        for filename in os.listdir(state_dir):
+            if derivative_run_pattern.match(filename) and filename not in live_runs:
+                os.remove(os.path.join(state_dir, filename))
+
+
+def _write_run(path, sorted_derivatives):
+    run_count = 0
+    with open(path, "w", encoding="utf-8", newline="\n") as run_file:
+        for derivative in sorted_derivatives:
+            run_file.write(derivative)
+            run_file.write("\n")
+            run_count += 1
+    return run_count
+
+
+def load_state(state_dir):
+    try:
+        with open(os.path.join(state_dir, state_filename), "rb") as state_file:
+            analysis_state = pickle.load(state_file)
+    except (IOError, pickle.UnpicklingError, EOFError):
+        return None
+    if getattr(analysis_state, "version", None) != state_version:
+        return None
+    return analysis_state
@@ -0,0 +1,91 @@
+import hashlib
+import math
+import mmap
+import struct
+
+file_magic = b"PABLOOM1"
+header_format = "<8sQQQ"
+header_size = struct.calcsize(header_format)
+default_false_positive_rate = 0.001
+minimum_bit_count = 1024
+
+
+def optimal_bit_count(capacity, false_positive_rate):
+    capacity = max(capacity, 1)
+    return max(int(math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2))), minimum_bit_count)
+
+
+def optimal_hash_count(false_positive_rate):
+    return max(int(round(-math.log(false_positive_rate, 2))), 1)
+
+
+class BloomFilter:
+    def __init__(self, capacity, false_positive_rate=default_false_positive_rate):
+        self.bit_count = optimal_bit_count(capacity, false_positive_rate)
+        self.hash_count = optimal_hash_count(false_positive_rate)
+        self.item_count = 0
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.bit_offset = 0
+        self._mapping = None
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first_hash, second_hash = struct.unpack("<QQ", digest)
+        for i in range(self.hash_count):
+            yield (first_hash + i * second_hash) % self.bit_count
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.item_count += 1
+
+    def add_if_absent(self, item):
+        bits = self.bits
+        positions = list(self._positions(item))
+        for position in positions:
+            if not bits[position >> 3] & (1 << (position & 7)):
+                break
+        else:
+            return False
+        for position in positions:
+            bits[position >> 3] |= 1 << (position & 7)
+        self.item_count += 1
+        return True
+
+    def contains(self, item):
+        bits = self.bits
+        bit_offset = self.bit_offset
+        for position in self._positions(item):
+            if not bits[bit_offset + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    def save(self, filename):
+        with open(filename, "wb") as filter_file:
+            filter_file.write(struct.pack(header_format, file_magic, self.bit_count, self.hash_count, self.item_count))
+            filter_file.write(self.bits[self.bit_offset:])
+
+    def close(self):
+        if self._mapping is not None:
+            self._mapping.close()
+            self._mapping = None
+
+    def __contains__(self, item):
+        return self.contains(item)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "rb") as filter_file:
+            mapping = mmap.mmap(filter_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, bit_count, hash_count, item_count = struct.unpack(header_format, mapping[:header_size])
+        if magic != file_magic:
+            mapping.close()
+            raise ValueError("'%s' is not a PotAnalyzer filter file" % filename)
+        bloom_filter = cls.__new__(cls)
+        bloom_filter.bit_count = bit_count
+        bloom_filter.hash_count = hash_count
+        bloom_filter.item_count = item_count
+        bloom_filter.bits = mapping
+        bloom_filter.bit_offset = header_size
+        bloom_filter._mapping = mapping
+        return bloom_filter
@@ -0,0 +1,122 @@
+import json
+import os
+import shutil
+import time
+from itertools import islice
+from analyzertools import potreader
+from analyzertools.dedupstore import iterate_collection_as_tuples
+
+checkpoint_version = 2
+checkpoint_filename = "checkpoint.json"
+working_filename = "working.txt"
+derivatives_filename = "derivatives.txt"
+journal_filename = "staged.journal"
+generation_filename = "generation_%d.txt"
+default_checkpoint_interval = 300
+
+
+def write_wordlist(filename, words):
+    with open(filename, "w", encoding="utf-8", newline="\n", buffering=1024 * 1024) as wordlist:
+        for word in words:
+            wordlist.write(word)
+            wordlist.write("\n")
+
+
+def load_checkpoint(checkpoint_dir):
+    try:
+        with open(os.path.join(checkpoint_dir, checkpoint_filename), "r") as checkpoint_file:
+            checkpoint_state = json.load(checkpoint_file)
+    except (IOError, ValueError):
+        return None
+    if checkpoint_state.get("version") != checkpoint_version:
+        return None
+    return checkpoint_state
+
+
+class Checkpointer:
+    def __init__(self, checkpoint_dir, settings, interval=default_checkpoint_interval):
+        self.checkpoint_dir = checkpoint_dir
+        self.settings = json.loads(json.dumps(settings))
+        self.interval = interval
+        self.depth = 0
+        self.position = 0
+        self.resuming = False
+        self.journal = None
+        self.generation_count = 0
+        self.last_checkpoint_time = time.time()
+
+    def _path(self, filename):
+        return os.path.join(self.checkpoint_dir, filename)
+
+    def matches(self, checkpoint_state):
+        return checkpoint_state is not None and checkpoint_state.get("settings") == self.settings
+
+    def resume(self, checkpoint_state, data_handler):
+        self.depth = checkpoint_state["depth"]
+        self.generation_count = checkpoint_state["generation_count"]
+        self.position = checkpoint_state["position"]
+        self.resuming = True
+        with open(self._path(journal_filename), "r+b") as journal:
+            journal.truncate(checkpoint_state["journal_size"])
+        generations = [self._iterate_words(generation_filename % generation)
+                       for generation in range(self.generation_count)]
+        data_handler.restore_passwords(self._iterate_words(working_filename),
+                                       self._iterate_words(derivatives_filename),
+                                       self._iterate_words(journal_filename), generations)
+        self.journal = open(self._path(journal_filename), "ab")
+
+    def is_resuming(self, depth):
+        return self.resuming and self.depth == depth
+
+    def start_depth(self, depth, working_passwords, derivatives, generations=()):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        self.close_journal()
+        write_wordlist(self._path(working_filename), working_passwords)
+        write_wordlist(self._path(derivatives_filename), derivatives)
+        self.generation_count = 0
+        for generation_passwords in generations:
+            write_wordlist(self._path(generation_filename % self.generation_count), generation_passwords)
+            self.generation_count += 1
+        self.journal = open(self._path(journal_filename), "wb")
+        self.depth = depth
+        self.position = 0
+        self.resuming = False
+        self.save()
+
+    def iterate_working_rows(self):
+        return iterate_collection_as_tuples(islice(self._iterate_words(working_filename), self.position, None))
+
+    def record_batch(self, batch_size, derivative_set):
+        self.position += batch_size
+        if len(derivative_set) > 0:
+            self.journal.write("\n".join(derivative_set).encode("utf-8"))
+            self.journal.write(b"\n")
+        if time.time() - self.last_checkpoint_time >= self.interval:
+            self.save()
+
+    def save(self):
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        checkpoint_state = {"version": checkpoint_version,
+                            "settings": self.settings,
+                            "depth": self.depth,
+                            "position": self.position,
+                            "generation_count": self.generation_count,
+                            "journal_size": self.journal.tell()}
+        temporary_path = self._path(checkpoint_filename + ".tmp")
+        with open(temporary_path, "w") as checkpoint_file:
+            json.dump(checkpoint_state, checkpoint_file)
+        os.replace(temporary_path, self._path(checkpoint_filename))
+        self.last_checkpoint_time = time.time()
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def remove(self):
+        self.close_journal()
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+
+    def _iterate_words(self, filename):
+        return potreader.PotfileReader(self._path(filename)).iterate_words()
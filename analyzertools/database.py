@@ -1,9 +1,8 @@
 import sqlite3
+from analyzertools import dedupstore
 
-
-def iterate_collection_as_tuples(collection):
-    for item in collection:
-        yield (item,)
+default_cache_size_kb = 256 * 1024
+cache_budget_share = 4
 
 
 class SqliteDataHandler:
@@ -12,61 +11,154 @@ class SqliteDataHandler:
     omissions = "omissions"
     derivatives = "derivatives"
 
-    def __init__(self):
+    def __init__(self, dedup_backend="sqlite", temp_dir=None, memory_budget=None, keep_generations=False):
         self.db = sqlite3.connect("")
-        self.db.execute("create table %s (password text, unique(password))" % self.staged_passwords)
-        self.db.execute("create table %s (password text, unique(password))" % self.working_passwords)
+        self.dedup_backend = dedup_backend
+        self.temp_dir = temp_dir
+        self.db.execute("pragma journal_mode = off")
+        self.db.execute("pragma synchronous = off")
+        # One budget is shared by the SQLite page cache and every live store, instead of a share per store
+        self.memory_budget = None
+        if memory_budget is not None:
+            self.memory_budget = dedupstore.MemoryBudget(memory_budget)
+            cache_size = self.memory_budget.reserve(memory_budget // cache_budget_share)
+            self.db.execute("pragma cache_size = -%d" % max(cache_size // 1024, 1))
+            self.db.execute("pragma temp_store = file")
+        else:
+            self.db.execute("pragma cache_size = -%d" % default_cache_size_kb)
         self.db.execute("create table %s (password text, unique(password))" % self.omissions)
-        self.db.execute("create table %s (password text, unique(password))" % self.derivatives)
+        self.store_count = 0
+        self.staged = self._create_store(self.staged_passwords)
+        self.working = self._create_store(self.working_passwords)
+        self.derived = self._create_store(self.derivatives)
+        self.keep_generations = keep_generations
+        self.generations = []
+        self.generation_counts = []
+        self.omission_filter = None
+        self.exact_omissions = True
+        self.has_omissions = False
         self.db.commit()
 
+    def _create_store(self, table):
+        self.store_count += 1
+        return dedupstore.create_password_store(self.dedup_backend, self.db, "%s_%d" % (table, self.store_count),
+                                                self.temp_dir, self.memory_budget)
+
+    def reserve_memory(self, size):
+        if self.memory_budget is None:
+            return size
+        return self.memory_budget.reserve(size)
+
     def commit(self):
         self.db.commit()
 
+    def set_omission_filter(self, omission_filter, exact=True):
+        self.omission_filter = omission_filter
+        self.exact_omissions = exact
+        self.has_omissions = True
+
     def add_omitted_password(self, password, auto_commit=True):
+        self.has_omissions = True
+        if self.omission_filter is not None:
+            self.omission_filter.add(password)
+            if not self.exact_omissions:
+                return
         self.db.execute("insert or ignore into {} values (?)".format(self.omissions), (password,))
         if auto_commit:
             self.db.commit()
 
     def password_is_omitted(self, password):
-        cursor = self.db.execute("select * from %s where password = ?" % self.omissions, (password,))
-        return cursor.rowcount > 0
+        if not self.has_omissions:
+            return False
+        if self.omission_filter is not None:
+            if not self.omission_filter.contains(password):
+                return False
+            if not self.exact_omissions:
+                return True
+        cursor = self.db.execute("select 1 from %s where password = ?" % self.omissions, (password,))
+        return cursor.fetchone() is not None
 
     def stage_password(self, password, auto_commit=True):
-        self.db.execute("insert or ignore into %s values (?)" % self.staged_passwords, (password,))
+        self.staged.add(password)
         if auto_commit:
             self.db.commit()
 
     def stage_many_passwords(self, collection, auto_commit=True):
-        self.db.executemany("insert or ignore into %s values(?)" % self.staged_passwords,
-                            iterate_collection_as_tuples(collection))
+        self.staged.add_many(collection)
         if auto_commit:
             self.db.commit()
 
     def flush_staged_passwords(self, auto_commit=True):
-        self.db.execute("insert or ignore into %s(password) select password from %s" % (self.derivatives,
-                                                                                        self.staged_passwords))
-        self.db.execute("insert or ignore into %s(password) select password from %s" % (self.working_passwords,
-                                                                                        self.staged_passwords))
-        self.db.execute("delete from %s" % self.staged_passwords)
+        frontier = self._create_store(self.working_passwords)
+        frontier.update_difference(self.staged, self.derived)
+        self.derived.update(frontier)
+        self.staged.clear()
+        self._set_frontier(frontier)
+        self.generation_counts.append(frontier.count())
+        if auto_commit:
+            self.db.commit()
+
+    def _set_frontier(self, frontier):
+        if self.working not in self.generations:
+            self.working.close()
+        if self.keep_generations:
+            self.generations.append(frontier)
+        self.working = frontier
+
+    def restore_passwords(self, working_passwords, derivatives, staged_passwords, generations=(), auto_commit=True):
+        for store, passwords in ((self.working, working_passwords), (self.derived, derivatives),
+                                 (self.staged, staged_passwords)):
+            store.clear()
+            store.add_many(passwords)
+        if self.keep_generations:
+            for store in self.generations:
+                if store is not self.working:
+                    store.close()
+            self.generations = []
+            for generation_passwords in generations:
+                store = self._create_store(self.working_passwords)
+                store.add_many(generation_passwords)
+                self.generations.append(store)
+            self.generations.append(self.working)
         if auto_commit:
             self.db.commit()
 
     def working_password_count(self):
-        return self.db.execute("select count(password) from %s" % self.working_passwords).fetchone()[0]
+        return self.working.count()
 
     def derivative_count(self):
-        return self.db.execute("select count(password) from %s" % self.derivatives).fetchone()[0]
+        return self.derived.count()
 
     def get_working_password_iterator(self):
-        cursor = self.db.execute("select password from %s" % self.working_passwords)
-        return cursor
+        return self.working.iterate_rows()
+
+    def get_generation_iterators(self):
+        return [store.iterate_rows() for store in self.generations]
 
     def get_derivative_iterator(self):
-        cursor = self.db.execute("select password from %s" % self.derivatives)
-        return cursor
+        return self.derived.iterate_rows()
+
+    def get_sorted_derivative_iterator(self):
+        return self.derived.iterate_sorted()
+
+    def discard_generations_after(self, max_generation, auto_commit=True):
+        if not self.keep_generations or max_generation + 1 >= len(self.generations):
+            return
+        self.derived.clear()
+        for store in self.generations[:max_generation + 1]:
+            self.derived.update(store)
+        if auto_commit:
+            self.db.commit()
 
     def close(self):
+        self.staged.close()
+        self.working.close()
+        self.derived.close()
+        for store in self.generations:
+            if store is not self.working:
+                store.close()
+        if self.omission_filter is not None:
+            self.omission_filter.close()
         self.db.close()
 
     def __enter__(self):
@@ -74,4 +166,3 @@ class SqliteDataHandler:
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
         self.close()
-
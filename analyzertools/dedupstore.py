@@ -0,0 +1,385 @@
+import heapq
+import os
+import tempfile
+from bisect import bisect_right
+from itertools import islice
+
+default_bulk_load_size = 500000
+sqlite_page_size = 10000
+default_spill_memory_budget = 256 * 1024 * 1024
+spill_entry_overhead = 90
+pending_entry_size = spill_entry_overhead + 16
+max_spill_runs = 64
+run_index_interval = 256
+
+
+def iterate_collection_as_tuples(collection):
+    for item in collection:
+        yield (item,)
+
+
+def iterate_unique(sorted_iterable):
+    previous = None
+    for item in sorted_iterable:
+        if item != previous:
+            yield item
+            previous = item
+
+
+def iterate_sorted_difference(sorted_items, sorted_excluded):
+    excluded = iter(sorted_excluded)
+    current_excluded = next(excluded, None)
+    for item in sorted_items:
+        while current_excluded is not None and current_excluded < item:
+            current_excluded = next(excluded, None)
+        if item != current_excluded:
+            yield item
+
+
+def iterate_run(path):
+    with open(path, "r", encoding="utf-8", newline="\n") as run_file:
+        for line in run_file:
+            yield line[:-1]
+
+
+class MemoryBudget:
+    def __init__(self, size):
+        self.size = size
+        self.available = size
+        self.used = 0
+        self.stores = []
+
+    def reserve(self, size):
+        reserved = min(size, self.available)
+        self.available -= reserved
+        return reserved
+
+    def register(self, store):
+        self.stores.append(store)
+
+    def unregister(self, store):
+        if store in self.stores:
+            self.stores.remove(store)
+
+    def release(self):
+        # Releasing the largest buffer first keeps spilled runs as long as the shared budget allows
+        if len(self.stores) > 0:
+            max(self.stores, key=lambda store: store.buffer_bytes).release_memory()
+
+
+class IndexedRun:
+    def __init__(self, sorted_items, temp_dir=None):
+        handle, self.path = tempfile.mkstemp(prefix="potanalyzer_", suffix=".run", dir=temp_dir)
+        self.index_keys = []
+        self.index_offsets = []
+        self.run_file = None
+        offset = 0
+        sorted_items = iter(sorted_items)
+        with os.fdopen(handle, "wb") as run_file:
+            while True:
+                block = list(islice(sorted_items, run_index_interval))
+                if len(block) == 0:
+                    break
+                self.index_keys.append(block[0])
+                self.index_offsets.append(offset)
+                encoded_block = ("\n".join(block) + "\n").encode("utf-8")
+                run_file.write(encoded_block)
+                offset += len(encoded_block)
+
+    def contains(self, item):
+        # The sparse index narrows a lookup to one block of the run instead of a scan from the start
+        position = bisect_right(self.index_keys, item) - 1
+        if position < 0:
+            return False
+        if self.run_file is None:
+            self.run_file = open(self.path, "rb")
+        self.run_file.seek(self.index_offsets[position])
+        for _ in range(run_index_interval):
+            line = self.run_file.readline()
+            if len(line) == 0:
+                return False
+            current_item = str(line[:-1], "utf-8")
+            if current_item >= item:
+                return current_item == item
+        return False
+
+    def remove(self):
+        if self.run_file is not None:
+            self.run_file.close()
+            self.run_file = None
+        os.remove(self.path)
+
+    def __iter__(self):
+        return iterate_run(self.path)
+
+
+class SqlitePasswordStore:
+    def __init__(self, db, table, bulk_load_size=default_bulk_load_size, memory_budget=None):
+        self.db = db
+        self.table = table
+        self.bulk_load_size = bulk_load_size
+        self.memory_budget = memory_budget
+        self.pending = set()
+        self.buffer_bytes = 0
+        self.db.execute("create table %s (password text, unique(password))" % self.table)
+        if memory_budget is not None:
+            memory_budget.register(self)
+
+    def add(self, password):
+        self.add_many((password,))
+
+    def add_many(self, collection):
+        pending_count = len(self.pending)
+        self.pending.update(collection)
+        if len(self.pending) >= self.bulk_load_size:
+            self.flush_pending()
+        elif self.memory_budget is not None:
+            added_bytes = (len(self.pending) - pending_count) * pending_entry_size
+            self.buffer_bytes += added_bytes
+            self.memory_budget.used += added_bytes
+            if self.memory_budget.used >= self.memory_budget.available:
+                self.memory_budget.release()
+
+    def flush_pending(self):
+        if len(self.pending) > 0:
+            self.db.executemany("insert or ignore into %s values(?)" % self.table,
+                                iterate_collection_as_tuples(sorted(self.pending)))
+            self.pending.clear()
+        self._release_buffer()
+
+    def _release_buffer(self):
+        if self.memory_budget is not None:
+            self.memory_budget.used -= self.buffer_bytes
+        self.buffer_bytes = 0
+
+    def release_memory(self):
+        self.flush_pending()
+
+    def update(self, other):
+        if isinstance(other, SqlitePasswordStore) and other.db is self.db:
+            other.flush_pending()
+            self.flush_pending()
+            self.db.execute("insert or ignore into %s(password) select password from %s order by password" %
+                            (self.table, other.table))
+        else:
+            self.add_many(other)
+
+    def update_difference(self, other, excluded):
+        if isinstance(other, SqlitePasswordStore) and isinstance(excluded, SqlitePasswordStore) and \
+                other.db is self.db and excluded.db is self.db:
+            other.flush_pending()
+            excluded.flush_pending()
+            self.flush_pending()
+            self.db.execute("insert or ignore into {0}(password) select password from {1} where not exists "
+                            "(select 1 from {2} where {2}.password = {1}.password) order by password"
+                            .format(self.table, other.table, excluded.table))
+        else:
+            self.add_many(password for password in other if not excluded.contains(password))
+
+    def contains(self, password):
+        if password in self.pending:
+            return True
+        cursor = self.db.execute("select 1 from %s where password = ?" % self.table, (password,))
+        return cursor.fetchone() is not None
+
+    def count(self):
+        self.flush_pending()
+        return self.db.execute("select count(password) from %s" % self.table).fetchone()[0]
+
+    def iterate_rows(self):
+        self.flush_pending()
+        last_rowid = 0
+        while True:
+            rows = self.db.execute("select rowid, password from %s where rowid > ? order by rowid limit ?" %
+                                   self.table, (last_rowid, sqlite_page_size)).fetchall()
+            if len(rows) == 0:
+                break
+            last_rowid = rows[-1][0]
+            for row in rows:
+                yield row[1:]
+
+    def iterate_sorted(self):
+        # SQLite compares text as UTF-8 bytes, which orders the same as Python strings
+        self.flush_pending()
+        rows = self.db.execute("select password from %s order by password limit ?" % self.table,
+                               (sqlite_page_size,)).fetchall()
+        while len(rows) > 0:
+            for row in rows:
+                yield row[0]
+            rows = self.db.execute("select password from %s where password > ? order by password limit ?" %
+                                   self.table, (rows[-1][0], sqlite_page_size)).fetchall()
+
+    def clear(self):
+        self.pending.clear()
+        self._release_buffer()
+        self.db.execute("delete from %s" % self.table)
+
+    def close(self):
+        self.pending.clear()
+        self._release_buffer()
+        if self.memory_budget is not None:
+            self.memory_budget.unregister(self)
+
+    def __iter__(self):
+        for row in self.iterate_rows():
+            yield row[0]
+
+
+class HashSetPasswordStore:
+    def __init__(self):
+        self.passwords = set()
+
+    def add(self, password):
+        self.passwords.add(password)
+
+    def add_many(self, collection):
+        self.passwords.update(collection)
+
+    def update(self, other):
+        if isinstance(other, HashSetPasswordStore):
+            self.passwords.update(other.passwords)
+        else:
+            self.passwords.update(other)
+
+    def update_difference(self, other, excluded):
+        if isinstance(other, HashSetPasswordStore) and isinstance(excluded, HashSetPasswordStore):
+            self.passwords.update(other.passwords.difference(excluded.passwords))
+        else:
+            self.add_many(password for password in other if not excluded.contains(password))
+
+    def contains(self, password):
+        return password in self.passwords
+
+    def count(self):
+        return len(self.passwords)
+
+    def iterate_rows(self):
+        return iterate_collection_as_tuples(self.passwords)
+
+    def iterate_sorted(self):
+        return iter(sorted(self.passwords))
+
+    def clear(self):
+        self.passwords.clear()
+
+    def close(self):
+        self.passwords.clear()
+
+    def __iter__(self):
+        return iter(self.passwords)
+
+
+class SpillingPasswordStore:
+    def __init__(self, memory_budget=None, temp_dir=None):
+        if memory_budget is None:
+            memory_budget = MemoryBudget(default_spill_memory_budget)
+        self.memory_budget = memory_budget
+        self.temp_dir = temp_dir
+        self.buffer = set()
+        self.buffer_bytes = 0
+        self.runs = []
+        self.modification_count = 0
+        self.unique_count = 0
+        self.counted_modification = 0
+        memory_budget.register(self)
+
+    def add(self, password):
+        if password not in self.buffer:
+            self.buffer.add(password)
+            self.modification_count += 1
+            entry_bytes = len(password) + spill_entry_overhead
+            self.buffer_bytes += entry_bytes
+            memory_budget = self.memory_budget
+            memory_budget.used += entry_bytes
+            if memory_budget.used >= memory_budget.available:
+                memory_budget.release()
+
+    def add_many(self, collection):
+        for password in collection:
+            self.add(password)
+
+    def update(self, other):
+        self.add_many(other)
+
+    def update_difference(self, other, excluded):
+        if isinstance(other, SpillingPasswordStore) and isinstance(excluded, SpillingPasswordStore):
+            self.add_many(iterate_sorted_difference(other, excluded))
+        else:
+            self.add_many(password for password in other if not excluded.contains(password))
+
+    def contains(self, password):
+        if password in self.buffer:
+            return True
+        for run in self.runs:
+            if run.contains(password):
+                return True
+        return False
+
+    def count(self):
+        if len(self.runs) == 0:
+            return len(self.buffer)
+        # Every complete pass over the store records its unique count, so only a store changed since its last
+        # pass is scanned here
+        if self.counted_modification != self.modification_count:
+            for _ in self:
+                pass
+        return self.unique_count
+
+    def iterate_rows(self):
+        return iterate_collection_as_tuples(self)
+
+    def iterate_sorted(self):
+        return iter(self)
+
+    def clear(self):
+        self._release_buffer()
+        for run in self.runs:
+            run.remove()
+        self.runs = []
+        self.modification_count += 1
+
+    def close(self):
+        self.clear()
+        self.memory_budget.unregister(self)
+
+    def release_memory(self):
+        self._spill()
+
+    def _release_buffer(self):
+        self.buffer.clear()
+        self.memory_budget.used -= self.buffer_bytes
+        self.buffer_bytes = 0
+
+    def _spill(self):
+        if len(self.buffer) == 0:
+            return
+        self.runs.append(IndexedRun(sorted(self.buffer), self.temp_dir))
+        self._release_buffer()
+        if len(self.runs) >= max_spill_runs:
+            merged_run = IndexedRun(iterate_unique(heapq.merge(*self.runs)), self.temp_dir)
+            for run in self.runs:
+                run.remove()
+            self.runs = [merged_run]
+
+    def __iter__(self):
+        modification_count = self.modification_count
+        unique_count = 0
+        for password in iterate_unique(heapq.merge(*self.runs, sorted(self.buffer))):
+            unique_count += 1
+            yield password
+        if modification_count == self.modification_count:
+            self.unique_count = unique_count
+            self.counted_modification = modification_count
+
+
+dedup_backends = ("sqlite", "hashset", "spill")
+
+
+def create_password_store(backend, db, table, temp_dir=None, memory_budget=None):
+    if backend == "sqlite":
+        return SqlitePasswordStore(db, table, memory_budget=memory_budget)
+    if backend == "hashset":
+        return HashSetPasswordStore()
+    if backend == "spill":
+        return SpillingPasswordStore(memory_budget, temp_dir)
+    raise ValueError("Unknown dedup backend '%s', expected one of %s" % (backend, ", ".join(dedup_backends)))
@@ -0,0 +1,95 @@
+from collections import Counter
+from itertools import combinations, islice, product
+from analyzertools import leetspeak, masktools, passwordtools
+
+# https://hashcat.net/wiki/doku.php?id=rule_based_attack
+rule_positions = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+noop_rule = ":"
+rule_separator = " "
+
+
+def iterate_mask_rules(password, character_pools):
+    for i in range(min(len(password), len(rule_positions))):
+        for char in character_pools[i]:
+            if char != password[i]:
+                yield "o" + rule_positions[i] + char
+
+
+def iterate_add_rules(password, character_pools):
+    add_pools = passwordtools.get_add_character_pools(character_pools)
+    for char in add_pools[0]:
+        yield "^" + char
+    for i in range(1, min(len(password), len(rule_positions))):
+        for char in add_pools[i]:
+            yield "i" + rule_positions[i] + char
+    if len(password) > 0:
+        for char in add_pools[len(password)]:
+            yield "$" + char
+
+
+def iterate_remove_rules(password):
+    if len(password) > 0:
+        yield "["
+    for i in range(1, min(len(password) - 1, len(rule_positions))):
+        yield "D" + rule_positions[i]
+    if len(password) > 1:
+        yield "]"
+
+
+def _iterate_substitution_rules(leet_chars, max_substitutions):
+    for substitution_count in range(1, max_substitutions + 1):
+        for substituted_chars in combinations(leet_chars, substitution_count):
+            # Substitutions that expand one character into several have no whole word rule equivalent
+            substitution_table = [[substitution for substitution in leetspeak.get_leet_substitutions(char)
+                                   if len(substitution) == 1] for char in substituted_chars]
+            for substitutions in product(*substitution_table):
+                yield rule_separator.join("s" + char + substitution
+                                          for char, substitution in zip(substituted_chars, substitutions))
+
+
+def iterate_leet_rules(password, leet_policy=None):
+    leet_chars = sorted(set(char for char in password if leetspeak.has_leet_substitutions(char)))
+    max_substitutions = len(leet_chars)
+    max_rules = None
+    if leet_policy is not None:
+        if leet_policy.max_substitutions is not None:
+            max_substitutions = min(max_substitutions, leet_policy.max_substitutions)
+        for limit in (leet_policy.max_candidates, leet_policy.top_k):
+            if limit is not None:
+                max_rules = limit if max_rules is None else min(max_rules, limit)
+    rules = _iterate_substitution_rules(leet_chars, max_substitutions)
+    if max_rules is not None:
+        rules = islice(rules, max_rules)
+    return rules
+
+
+def get_password_rules(password, leet_policy=None):
+    character_pools = masktools.get_character_pools(password)
+    rule_set = set(iterate_mask_rules(password, character_pools))
+    rule_set.update(iterate_add_rules(password, character_pools))
+    rule_set.update(iterate_remove_rules(password))
+    rule_set.update(iterate_leet_rules(password, leet_policy))
+    return rule_set
+
+
+def count_batch_rules(password_batch, length_limit=None, leet_policy=None):
+    rule_counts = Counter()
+    derivative_estimate = 0
+    for password in password_batch:
+        if length_limit is None or len(password) <= length_limit:
+            rule_set = get_password_rules(password, leet_policy)
+            rule_counts.update(rule_set)
+            derivative_estimate += len(rule_set)
+    return rule_counts, derivative_estimate
+
+
+def get_rule_keyspace(word_count, rule_count, depth=1):
+    return word_count * rule_count ** depth
+
+
+def write_rule_file(filename, rule_counts):
+    with open(filename, "w") as outfile:
+        outfile.write(noop_rule + "\n")
+        for rule, count in sorted(rule_counts.items(), key=lambda rule_count: (-rule_count[1], rule_count[0])):
+            outfile.write(rule + "\n")
+    return len(rule_counts) + 1
@@ -1,4 +1,6 @@
-
+import math
+from heapq import heappop, heappush, nsmallest
+from itertools import combinations, islice, product
 
 # http://www.gamehouse.com/blog/leet-speak-cheat-sheet/
 leet_dict = {"a": ("4", "@"),
@@ -54,77 +56,152 @@ def deleet(char):
     return reverse_leet_dict[char]
 
 
-class CascadeCounter:
-    def __init__(self, max_value):
-        self.next_counter = None
-        self.value = 0
-        self.max_value = max_value
-
-    def increment(self):
-        self.value += 1
-        if self.value > self.max_value:
-            self.value = 0
-            if self.next_counter is not None:
-                self.next_counter.increment()
-
-    def is_max(self):
-        return self.value == self.max_value
-
-    def __str__(self):
-        return str(self.value)
-
-    def __repr__(self):
-        return str("(" + str(self.value) + "/" + str(self.max_value) + ")")
-
-
-class LeetGenerator:
-    def __init__(self, password):
-        self.has_next = False
-        self.omni_mask = self.__getmask__(password)
-        self.counter_list = []
-        self.counter_head = None
-        self.counter_tail = None
-        for i in range(len(self.omni_mask)):
-            mask_chars = self.omni_mask[i]
-            max_value = len(mask_chars) - 1
-            self.__appendcounter__(max_value)
-            if max_value > 0:
-                self.has_next = True
-        self.__increment__()
-
-    def __appendcounter__(self, max_value):
-        counter = CascadeCounter(max_value)
-        self.counter_list.append(counter)
-        if self.counter_head is None:
-            self.counter_head = counter
-            self.counter_tail = counter
+leet_options = {char: (char,) + substitutions for char, substitutions in leet_dict.items()}
+
+
+def get_leet_options(char):
+    return leet_options.get(char, (char,))
+
+
+def get_substitution_weights(word_variant_pairs):
+    observations = {}
+    for normalized_word, variant in word_variant_pairs:
+        if len(normalized_word) != len(variant):
+            continue
+        for plain_char, variant_char in zip(normalized_word, variant):
+            if not has_leet_substitutions(plain_char):
+                continue
+            if variant_char.lower() == plain_char:
+                variant_char = plain_char
+            elif variant_char not in leet_dict[plain_char]:
+                continue
+            key = (plain_char, variant_char)
+            observations[key] = observations.get(key, 0) + 1
+    substitution_weights = {}
+    for char, options in leet_options.items():
+        total = sum(observations.get((char, option), 0) for option in options)
+        for option in options:
+            substitution_weights[(char, option)] = (observations.get((char, option), 0) + 1.0) / (total + len(options))
+    return substitution_weights
+
+
+class LeetPolicy:
+    def __init__(self, max_substitutions=None, max_candidates=None, top_k=None, substitution_weights=None):
+        self.max_substitutions = max_substitutions
+        self.max_candidates = max_candidates
+        self.top_k = top_k
+        self.substitution_weights = substitution_weights
+
+    def is_bounded(self):
+        return self.max_substitutions is not None or self.max_candidates is not None or self.top_k is not None
+
+
+def _iterate_all_permutations(password, positions):
+    # Vary the first position fastest, matching the original cascading counter order
+    permutation_builder = list(password)
+    option_table = [get_leet_options(password[i]) for i in reversed(positions)]
+    reversed_positions = positions[::-1]
+    permutations = product(*option_table)
+    next(permutations)
+    for permutation in permutations:
+        for position, char in zip(reversed_positions, permutation):
+            permutation_builder[position] = char
+        yield "".join(permutation_builder)
+
+
+def _iterate_limited_permutations(password, positions, max_substitutions):
+    permutation_builder = list(password)
+    for substitution_count in range(1, min(max_substitutions, len(positions)) + 1):
+        for substituted_positions in combinations(positions, substitution_count):
+            substitution_table = [leet_dict[password[i]] for i in substituted_positions]
+            for permutation in product(*substitution_table):
+                for position, char in zip(substituted_positions, permutation):
+                    permutation_builder[position] = char
+                yield "".join(permutation_builder)
+                for position in substituted_positions:
+                    permutation_builder[position] = password[position]
+
+
+def _get_ranked_options(password, positions, substitution_weights):
+    ranked_options = []
+    for i in positions:
+        char = password[i]
+        options = get_leet_options(char)
+        if substitution_weights is None:
+            costs = [0.0 if option == char else 1.0 for option in options]
         else:
-            self.counter_tail.next_counter = counter
-            self.counter_tail = counter
-
-    def __getmask__(self, password):
-        omni_mask = []
-        for char in password:
-            if has_leet_substitutions(char):
-                omni_mask.append((char,) + get_leet_substitutions(char))
-            else:
-                omni_mask.append((char,))
-        return omni_mask
-
-    def __increment__(self):
-        self.counter_head.increment()
-        for counter in self.counter_list:
-            if counter.value != 0:
-                return
-        self.has_next = False
-
-    def get_next_permutation(self):
-        permutation_builder = []
-        for i in range(len(self.omni_mask)):
-            char_options = self.omni_mask[i]
-            current_index = self.counter_list[i].value
-            char = char_options[current_index]
-            permutation_builder.append(char)
-        self.__increment__()
-        return "".join(permutation_builder)
-
+            costs = [-math.log(substitution_weights.get((char, option), 1.0 / len(options))) for option in options]
+        ranked_options.append(sorted(zip(costs, options)))
+    return ranked_options
+
+
+def _iterate_ranked_permutations(password, positions, substitution_weights):
+    ranked_options = _get_ranked_options(password, positions, substitution_weights)
+    start_state = (0,) * len(positions)
+    start_cost = sum(options[0][0] for options in ranked_options)
+    heap = [(start_cost, start_state, 0)]
+    permutation_builder = list(password)
+    while len(heap) > 0:
+        cost, state, last_position = heappop(heap)
+        substitution_count = 0
+        for j in range(len(positions)):
+            char = ranked_options[j][state[j]][1]
+            permutation_builder[positions[j]] = char
+            if char != password[positions[j]]:
+                substitution_count += 1
+        if substitution_count > 0:
+            yield "".join(permutation_builder)
+        for j in range(last_position, len(positions)):
+            if state[j] + 1 < len(ranked_options[j]):
+                next_state = state[:j] + (state[j] + 1,) + state[j + 1:]
+                next_cost = cost - ranked_options[j][state[j]][0] + ranked_options[j][state[j] + 1][0]
+                heappush(heap, (next_cost, next_state, j))
+
+
+def _iterate_ranked_limited_permutations(password, positions, substitution_weights, max_substitutions, count):
+    # Ranking the bounded substitutions keeps the work polynomial, the best first search would still walk every
+    # permutation over the substitution cap. Ties are broken by option rank, as the search breaks them
+    ranked_options = _get_ranked_options(password, positions, substitution_weights)
+    option_ranks = [{option: (cost, rank) for rank, (cost, option) in enumerate(options)} for options in ranked_options]
+    original_ranks = [option_ranks[j][password[i]] for j, i in enumerate(positions)]
+    position_indexes = {i: j for j, i in enumerate(positions)}
+
+    def get_priority(substitution):
+        ranks = list(original_ranks)
+        for position, char in zip(*substitution):
+            j = position_indexes[position]
+            ranks[j] = option_ranks[j][char]
+        return sum(cost for cost, rank in ranks), tuple(rank for cost, rank in ranks)
+
+    substitutions = ((substituted_positions, permutation)
+                     for substitution_count in range(1, min(max_substitutions, len(positions)) + 1)
+                     for substituted_positions in combinations(positions, substitution_count)
+                     for permutation in product(*[leet_dict[password[i]] for i in substituted_positions]))
+    permutation_builder = list(password)
+    for substituted_positions, permutation in nsmallest(count, substitutions, key=get_priority):
+        for position, char in zip(substituted_positions, permutation):
+            permutation_builder[position] = char
+        yield "".join(permutation_builder)
+        for position in substituted_positions:
+            permutation_builder[position] = password[position]
+
+
+def iterate_leet_permutations(password, leet_policy=None):
+    positions = [i for i in range(len(password)) if has_leet_substitutions(password[i])]
+    if len(positions) == 0:
+        return iter(())
+    if leet_policy is None or not leet_policy.is_bounded():
+        return _iterate_all_permutations(password, positions)
+    if leet_policy.top_k is not None:
+        count = min(leet_policy.top_k, leet_policy.max_candidates or leet_policy.top_k)
+        if leet_policy.max_substitutions is not None:
+            return _iterate_ranked_limited_permutations(password, positions, leet_policy.substitution_weights,
+                                                        leet_policy.max_substitutions, count)
+        return islice(_iterate_ranked_permutations(password, positions, leet_policy.substitution_weights), count)
+    if leet_policy.max_substitutions is not None:
+        permutations = _iterate_limited_permutations(password, positions, leet_policy.max_substitutions)
+    else:
+        permutations = _iterate_all_permutations(password, positions)
+    if leet_policy.max_candidates is not None:
+        permutations = islice(permutations, leet_policy.max_candidates)
+    return permutations
@@ -1,4 +1,6 @@
-
+import heapq
+import re
+from collections import Counter
 
 alpha_lower_mask = "?l"
 alpha_lower_pool = "abcdefghijklmnopqrstuvwxyz"
@@ -12,11 +14,31 @@ digit_pool = "0123456789"
 special_mask = "?s"
 special_pool = "!\"#$%&'()*+,-./:;<=>?@[]^_`{|}~"
 
+# Hashcat's built in charsets, ?s also covers the space and backslash
+hashcat_charset_sizes = {alpha_lower_mask: 26, alpha_upper_mask: 26, digit_mask: 10, special_mask: 33}
+
 year_length = 4
 recent_centuries = ("19", "20")
 famous_pre_1900_years = ("1054", "1088", "1206", "1215", "1453", "1455", "1492", "1509", "1517", "1519", "1564", "1651",
                          "1687", "1776", "1789", "1815", "1825", "1859", "1885", "1893")
 
+minimum_fragment_length = 2
+max_fragment_length = 6
+# Lossy counting undercounts a fragment by at most this share of all fragment occurrences
+fragment_error_rate = 0.00001
+max_fragments_per_segment = 8
+minimum_fragment_share = 0.02
+minimum_segment_coverage = 0.6
+minimum_segment_occurrences = 100
+# Masks this small stay in the attack next to their literals even when the literals cover every occurrence
+cheap_mask_keyspace = 1000000
+# Literals hcmask files can't hold without escaping a comma or starting a comment
+unsafe_fragment_characters = ",#\\"
+fragment_pattern = re.compile("|".join("(?<![%(pool)s])[%(pool)s]{%(minimum)d,%(maximum)d}(?![%(pool)s])" %
+                                       {"pool": re.escape(pool), "minimum": minimum_fragment_length,
+                                        "maximum": max_fragment_length}
+                                       for pool in (alpha_lower_pool, alpha_upper_pool, digit_pool, special_pool)))
+
 
 def get_character_mask(char):
     if char in alpha_lower_pool:
@@ -28,23 +50,201 @@ def get_character_mask(char):
     return special_mask
 
 
+mask_code_masks = (alpha_lower_mask, alpha_upper_mask, digit_mask, special_mask)
+mask_code_digits = {mask: str(digit) for digit, mask in enumerate(mask_code_masks)}
+mask_code_base = 4
+mask_code_pair_strings = {format(digit, "02b"): mask for digit, mask in enumerate(mask_code_masks)}
+
+
+def _build_mask_code_table(separator=None):
+    table = bytearray(mask_code_digits[special_mask].encode("ascii") * 256)
+    for pool, mask in ((alpha_lower_pool, alpha_lower_mask), (alpha_upper_pool, alpha_upper_mask),
+                       (digit_pool, digit_mask)):
+        for char in pool:
+            table[ord(char)] = ord(mask_code_digits[mask])
+    if separator is not None:
+        table[ord(separator)] = ord(separator)
+    return bytes(table)
+
+
+mask_block_separator = "\n"
+mask_code_table = _build_mask_code_table()
+mask_block_table = _build_mask_code_table(mask_block_separator)
+mask_code_strings = {ord(digit): mask for mask, digit in mask_code_digits.items()}
+
+
+def get_mask_code(password):
+    if password.isascii():
+        return password.encode("ascii").translate(mask_code_table)
+    return "".join([mask_code_digits[get_character_mask(char)] for char in password]).encode("ascii")
+
+
+def get_mask_codes(passwords):
+    block = mask_block_separator.join(passwords)
+    if not block.isascii() or block.count(mask_block_separator) != len(passwords) - 1:
+        return [get_mask_code(password) for password in passwords]
+    if len(passwords) == 0:
+        return []
+    return block.encode("ascii").translate(mask_block_table).split(mask_block_separator.encode("ascii"))
+
+
+def pack_mask_code(mask_code):
+    return int(b"1" + mask_code, mask_code_base)
+
+
+def count_mask_codes(passwords, mask_counter=None):
+    if mask_counter is None:
+        mask_counter = Counter()
+    for mask_code, occurrences in Counter(get_mask_codes(passwords)).items():
+        mask_counter[pack_mask_code(mask_code)] += occurrences
+    return mask_counter
+
+
+class FragmentCounter:
+    def __init__(self, error_rate=fragment_error_rate):
+        self.bucket_width = int(round(1.0 / error_rate))
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+        self.error_bound = 0
+
+    def prune(self):
+        # Only fragments that can't have been seen more than the error bound are dropped, so a fragment is never
+        # lost for being spread thinly over the potfile
+        self.error_bound = max(self.error_bound, self.total // self.bucket_width)
+        if self.error_bound == 0:
+            return
+        counts = self.counts
+        errors = self.errors
+        error_bound = self.error_bound
+        for fragment_key in [fragment_key for fragment_key, occurrences in counts.items()
+                             if occurrences + errors.get(fragment_key, 0) <= error_bound]:
+            del counts[fragment_key]
+            errors.pop(fragment_key, None)
+
+    def merge(self, other):
+        counts = self.counts
+        errors = self.errors
+        for fragment_key, occurrences in other.counts.items():
+            if fragment_key in counts:
+                counts[fragment_key] += occurrences
+                error = errors.get(fragment_key, 0) + other.errors.get(fragment_key, 0)
+            else:
+                counts[fragment_key] = occurrences
+                error = self.error_bound + other.errors.get(fragment_key, 0)
+            if error > 0:
+                errors[fragment_key] = error
+        if other.error_bound > 0:
+            for fragment_key in counts:
+                if fragment_key not in other.counts:
+                    errors[fragment_key] = errors.get(fragment_key, 0) + other.error_bound
+        self.total += other.total
+        self.error_bound += other.error_bound
+
+    def items(self):
+        return self.counts.items()
+
+    def __len__(self):
+        return len(self.counts)
+
+
+def count_literal_fragments(passwords, fragment_counter=None, weight=1):
+    if fragment_counter is None:
+        fragment_counter = FragmentCounter()
+    counts = fragment_counter.counts
+    errors = fragment_counter.errors
+    error_bound = fragment_counter.error_bound
+    total = 0
+    # Fragments are counted per mask and position, so a literal is only ever offered for the mask it was seen in
+    packed_mask_codes = [pack_mask_code(mask_code) for mask_code in get_mask_codes(passwords)]
+    find_fragments = fragment_pattern.finditer
+    for fragment_key, occurrences in Counter([(packed_mask_code, match.start(), match.group())
+                                              for password, packed_mask_code in zip(passwords, packed_mask_codes)
+                                              for match in find_fragments(password)]).items():
+        occurrences *= weight
+        total += occurrences
+        if fragment_key in counts:
+            counts[fragment_key] += occurrences
+        else:
+            counts[fragment_key] = occurrences
+            if error_bound > 0:
+                errors[fragment_key] = error_bound
+    fragment_counter.total += total
+    return fragment_counter
+
+
+def get_fragment_index(fragment_counter, mask_counter, minimum_count):
+    segment_fragments = {}
+    for (packed_mask_code, start, fragment), occurrences in fragment_counter.items():
+        if occurrences < minimum_count or any(char in unsafe_fragment_characters for char in fragment):
+            continue
+        mask_occurrences = mask_counter.get(packed_mask_code, 0)
+        if mask_occurrences < minimum_segment_occurrences or \
+                occurrences < mask_occurrences * minimum_fragment_share:
+            continue
+        segment_fragments.setdefault((packed_mask_code, start), []).append((occurrences, fragment))
+    fragment_index = {}
+    for (packed_mask_code, start), fragments in segment_fragments.items():
+        mask_occurrences = mask_counter[packed_mask_code]
+        fragments.sort(key=lambda fragment: (-fragment[0], fragment[1]))
+        # Only segments a handful of literals mostly cover are worth specialising
+        covered = 0
+        for i in range(min(len(fragments), max_fragments_per_segment)):
+            covered += fragments[i][0]
+            if covered >= mask_occurrences * minimum_segment_coverage:
+                mask = mask_code_to_string(packed_mask_code)
+                segment = (float(covered) / mask_occurrences, start, start + len(fragments[0][1]),
+                           [(fragment, float(occurrences) / mask_occurrences)
+                            for occurrences, fragment in fragments[:i + 1]])
+                if mask not in fragment_index or (segment[0], -start) > (fragment_index[mask][0],
+                                                                         -fragment_index[mask][1]):
+                    fragment_index[mask] = segment
+                break
+    return fragment_index
+
+
+def mask_code_to_string(packed_mask_code):
+    bits = format(packed_mask_code, "b")
+    return "".join([mask_code_pair_strings[bits[i:i + 2]] for i in range(1, len(bits), 2)])
+
+
+def get_ordered_mask_counts(mask_counter, minimum_count, cumulative_count):
+    selection_size = 256
+    boundary_count = 0
+    while True:
+        top_counts = heapq.nlargest(selection_size, mask_counter.values())
+        total = 0
+        for occurrences in top_counts:
+            total += occurrences
+            if total > cumulative_count:
+                boundary_count = occurrences
+                break
+        if total > cumulative_count or len(top_counts) < selection_size:
+            break
+        selection_size *= 4
+    boundary_count = min(boundary_count, minimum_count)
+    ordered_masks = [(v, mask_code_to_string(k)) for k, v in mask_counter.items() if v >= boundary_count]
+    ordered_masks.sort(reverse=True)
+    return ordered_masks
+
+
 def get_mask(password):
-    mask = []
-    for char in password:
-        mask.append(get_character_mask(char))
-    return mask
+    return [mask_code_strings[code] for code in get_mask_code(password)]
+
+
+mask_pools = {alpha_lower_mask: alpha_lower_pool,
+              alpha_upper_mask: alpha_upper_pool,
+              digit_mask: digit_pool,
+              special_mask: special_pool}
+mask_code_pools = {ord(mask_code_digits[mask]): pool for mask, pool in mask_pools.items()}
 
 
 def get_character_pool_from_mask_code(mask_code):
-    if mask_code == alpha_lower_mask:
-        return alpha_lower_pool
-    if mask_code == alpha_upper_mask:
-        return alpha_upper_pool
-    if mask_code == digit_mask:
-        return digit_pool
-    if mask_code == special_mask:
-        return special_pool
-    return ""
+    return mask_pools.get(mask_code, "")
+
+
+def get_character_pools(password):
+    return [mask_code_pools[code] for code in get_mask_code(password)]
 
 
 def _generate_mask_builder(mask):
@@ -91,14 +291,64 @@ def _get_year_mask_permutations(mask_builder):
     return derivatives
 
 
-def get_mask_attack_suggestions(mask_list):
+def _get_specialised_masks(mask_builder, occurrences, segment):
+    coverage, start, end, fragments = segment
+    prefix = "".join(mask_builder[:start])
+    suffix = "".join(mask_builder[end:])
+    specialised_masks = [(occurrences * share, [prefix + fragment.replace("?", "??") + suffix])
+                         for fragment, share in fragments]
+    # The literals only cover what the potfile showed, so the plain mask still follows them for the rest
+    mask = "".join(mask_builder)
+    if coverage < 1.0 or get_mask_keyspace(mask) <= cheap_mask_keyspace:
+        specialised_masks.append((occurrences * max(1.0 - coverage, 0.0), [mask]))
+    return specialised_masks
+
+
+def get_mask_attack_items(mask, occurrences, fragment_index=None):
+    mask_builder = _generate_mask_builder(mask)
+    if fragment_index:
+        segment = fragment_index.get(mask)
+        if segment is None:
+            return [(occurrences, [mask])]
+        return _get_specialised_masks(mask_builder, occurrences, segment)
+    year_derivatives = _get_year_mask_permutations(mask_builder)
+    if len(year_derivatives) == 0:
+        return [(occurrences, [mask])]
+    return [(occurrences, year_derivatives)]
+
+
+def get_mask_attack_suggestions(mask_list, fragment_index=None):
     derivatives = []
     for mask in mask_list:
-        mask_builder = _generate_mask_builder(mask)
-        year_derivatives = _get_year_mask_permutations(mask_builder)
-        if len(year_derivatives) == 0:
-            derivatives.append(mask)
-        else:
-            derivatives.extend(year_derivatives)
+        for occurrences, suggestions in get_mask_attack_items(mask, 1, fragment_index):
+            derivatives.extend(suggestions)
     return derivatives
 
+
+def get_mask_keyspace(mask):
+    keyspace = 1
+    i = 0
+    while i < len(mask):
+        if mask[i] == "?":
+            keyspace *= hashcat_charset_sizes.get(mask[i:i + 2], 1)
+            i += 2
+        else:
+            i += 1
+    return keyspace
+
+
+def get_mask_attack_plan(count_mask_pairs, hash_rate, time_budget, fragment_index=None):
+    mask_groups = []
+    for mask_occurrences, mask in count_mask_pairs:
+        for occurrences, suggestions in get_mask_attack_items(mask, mask_occurrences, fragment_index):
+            keyspace = sum(get_mask_keyspace(suggestion) for suggestion in suggestions)
+            mask_groups.append((float(occurrences) / keyspace, occurrences, suggestions, keyspace))
+    mask_groups.sort(key=lambda mask_group: (-mask_group[0], -mask_group[1]))
+    # Greedy knapsack by cracks per candidate, skipping masks that no longer fit the remaining budget
+    remaining_keyspace = hash_rate * time_budget
+    planned_masks = []
+    for density, occurrences, suggestions, keyspace in mask_groups:
+        if keyspace <= remaining_keyspace:
+            remaining_keyspace -= keyspace
+            planned_masks.extend(suggestions)
+    return planned_masks
@@ -1,27 +1,83 @@
 import getopt
+from analyzertools import bloomfilter, dedupstore, potcache, streaming
+
+index_command = "index"
 
 
 class Parameters:
-    unix_options = "hd:o:aw:p:l:"
-    gnu_options = ["help", "depth=", "output=", "analyze-only", "mask-weight-cutoff=", "previous-passwords=", "deriver-length-limit="]
+    unix_options = "hd:o:aw:p:l:j:i"
+    gnu_options = ["help", "depth=", "output=", "analyze-only", "mask-weight-cutoff=", "previous-passwords=", "deriver-length-limit=",
+                   "workers=", "dedup-backend=",
+                   "omission-filter=", "omission-fp-rate=", "approximate-omissions",
+                   "leet-max-substitutions=", "leet-max-candidates=", "leet-top-k=",
+                   "memory-budget=", "temp-dir=", "incremental", "state-dir=",
+                   "checkpoint-interval=", "checkpoint-dir=", "resume",
+                   "stats-json=", "profile=", "output-max-depth=", "max-word-variants=",
+                   "stream=", "stream-capacity=", "stream-fp-rate=",
+                   "prioritize", "max-candidates=", "hashcat-rules",
+                   "hash-rate=", "time-budget=", "cache=", "hash-fields="]
 
     def __init__(self, argument_input):
         self.display_help = False
+        self.command = None
         self.depth = 1
         self.derivative_output_name = "derivatives.txt"
         self.maskfile_output_name = "masks.hcmask"
+        self.rule_output_name = "derivatives.rule"
+        self.wordlist_output_name = "wordlist.txt"
         self.analysis_output_name = "analysis.txt"
         self.potfile_backup_name = "processed.potfile"
         self.previous_passwords = None
         self.mask_weight_cutoff = 0.30
+        self.hash_rate = None
+        self.time_budget = None
         self.analyze_only = False
         self.derivative_base_length_limit = 16
-        if argument_input[1].startswith("-"):
+        self.workers = 1
+        self.dedup_backend = None
+        self.memory_budget = None
+        self.temp_dir = None
+        self.incremental = False
+        self.state_dir = "potanalyzer_state"
+        self.checkpoint_interval = None
+        self.checkpoint_dir = "potanalyzer_checkpoint"
+        self.resume = False
+        self.stats_json_name = None
+        self.profile_name = None
+        self.output_max_depth = None
+        self.max_word_variants = None
+        self.stream_target = None
+        self.prioritize = False
+        self.max_candidates = None
+        self.hashcat_rules = False
+        self.stream_capacity = streaming.default_stream_capacity
+        self.stream_false_positive_rate = bloomfilter.default_false_positive_rate
+        self.omission_filter_name = None
+        self.omission_false_positive_rate = 0.001
+        self.exact_omissions = True
+        self.leet_max_substitutions = None
+        self.leet_max_candidates = None
+        self.leet_top_k = None
+        self.cache_name = None
+        self.hash_fields = None
+        potfile_index = 1
+        if argument_input[1] == index_command:
+            self.command = index_command
+            potfile_index = 2
+        if len(argument_input) <= potfile_index or argument_input[potfile_index].startswith("-"):
             self.display_help = True
         else:
-            self.potfile_name = argument_input[1]
-            if len(argument_input) > 2:
-                self._parse_optional_arguments(argument_input[2:])
+            self.potfile_name = argument_input[potfile_index]
+            if len(argument_input) > potfile_index + 1:
+                self._parse_optional_arguments(argument_input[potfile_index + 1:])
+            if self.cache_name is None:
+                self.cache_name = potcache.get_cache_filename(self.potfile_name)
+        if self.hashcat_rules:
+            self.stream_target = None
+            self.prioritize = False
+            self.max_candidates = None
+        if self.dedup_backend is None:
+            self.dedup_backend = "sqlite" if self.memory_budget is None else "spill"
 
     def _parse_optional_arguments(self, optional_arguments):
         arguments, values = getopt.getopt(optional_arguments, self.unix_options, self.gnu_options)
@@ -33,6 +89,8 @@ class Parameters:
             elif current_argument in ("-o", "--output"):
                 self.derivative_output_name = current_value + "_derivatives.txt"
                 self.maskfile_output_name = current_value + "_masks.hcmask"
+                self.rule_output_name = current_value + "_derivatives.rule"
+                self.wordlist_output_name = current_value + "_wordlist.txt"
                 self.analysis_output_name = current_value + "_analysis.txt"
                 self.potfile_backup_name = current_value + "_processed.potfile"
             elif current_argument in ("-a", "--analyze-only"):
@@ -42,4 +100,65 @@ class Parameters:
             elif current_argument in ("-p", "--previous-passwords"):
                 self.previous_passwords = current_value
             elif current_argument in ("-l", "--deriver-length-limit"):
-                self.derivative_base_length_limit = current_value
+                self.derivative_base_length_limit = int(current_value)
+            elif current_argument in ("-j", "--workers"):
+                self.workers = max(int(current_value), 1)
+            elif current_argument == "--dedup-backend":
+                if current_value not in dedupstore.dedup_backends:
+                    raise getopt.GetoptError("unknown dedup backend '%s'" % current_value)
+                self.dedup_backend = current_value
+            elif current_argument == "--omission-filter":
+                self.omission_filter_name = current_value
+            elif current_argument == "--omission-fp-rate":
+                self.omission_false_positive_rate = min(max(float(current_value), 1e-9), 0.5)
+            elif current_argument == "--approximate-omissions":
+                self.exact_omissions = False
+            elif current_argument == "--leet-max-substitutions":
+                self.leet_max_substitutions = max(int(current_value), 1)
+            elif current_argument == "--leet-max-candidates":
+                self.leet_max_candidates = max(int(current_value), 1)
+            elif current_argument == "--leet-top-k":
+                self.leet_top_k = max(int(current_value), 1)
+            elif current_argument == "--memory-budget":
+                self.memory_budget = max(int(current_value), 1) * 1024 * 1024
+            elif current_argument == "--temp-dir":
+                self.temp_dir = current_value
+            elif current_argument in ("-i", "--incremental"):
+                self.incremental = True
+            elif current_argument == "--state-dir":
+                self.state_dir = current_value
+            elif current_argument == "--checkpoint-interval":
+                self.checkpoint_interval = max(float(current_value), 0.0)
+            elif current_argument == "--checkpoint-dir":
+                self.checkpoint_dir = current_value
+            elif current_argument == "--resume":
+                self.resume = True
+            elif current_argument == "--stats-json":
+                self.stats_json_name = current_value
+            elif current_argument == "--profile":
+                self.profile_name = current_value
+            elif current_argument == "--output-max-depth":
+                self.output_max_depth = max(int(current_value), 0)
+            elif current_argument == "--max-word-variants":
+                self.max_word_variants = max(int(current_value), 1)
+            elif current_argument == "--stream":
+                self.stream_target = current_value
+            elif current_argument == "--stream-capacity":
+                self.stream_capacity = max(int(current_value), 1)
+            elif current_argument == "--stream-fp-rate":
+                self.stream_false_positive_rate = min(max(float(current_value), 1e-9), 0.5)
+            elif current_argument == "--prioritize":
+                self.prioritize = True
+            elif current_argument == "--max-candidates":
+                self.max_candidates = max(int(current_value), 1)
+                self.prioritize = True
+            elif current_argument == "--hashcat-rules":
+                self.hashcat_rules = True
+            elif current_argument == "--hash-rate":
+                self.hash_rate = max(float(current_value), 1.0)
+            elif current_argument == "--time-budget":
+                self.time_budget = max(float(current_value), 0.0)
+            elif current_argument == "--cache":
+                self.cache_name = current_value
+            elif current_argument == "--hash-fields":
+                self.hash_fields = max(int(current_value), 1)
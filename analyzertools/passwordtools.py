@@ -1,141 +1,205 @@
+import re
+from collections import Counter
+from itertools import repeat
 from analyzertools import leetspeak, masktools
 
 
-CHAR_OTHER = 0
-CHAR_UPPER = 1
-CHAR_LOWER = 2
-CHAR_DIGIT = 3
-CHAR_LEET = 4
+CHAR_OTHER = "O"
+CHAR_UPPER = "U"
+CHAR_LOWER = "L"
+CHAR_DIGIT = "D"
+CHAR_LEET = "K"
+CHAR_LEET_DIGIT = "k"
 
 
-def _generate_character_replace_derivatives(password, character_index, character_pool):
-    derivative_set = set()
-    for char in character_pool:
-        if password[character_index] == char:
+def _get_add_character_pool_table():
+    pools = list(masktools.mask_pools.values()) + [None]
+    add_character_pools = {}
+    for previous_pool in pools:
+        for next_pool in pools:
+            neighbour_pools = []
+            if previous_pool is not None:
+                neighbour_pools.append(previous_pool)
+            if next_pool is not None and next_pool not in neighbour_pools:
+                neighbour_pools.append(next_pool)
+            add_character_pools[(previous_pool, next_pool)] = "".join(neighbour_pools)
+    return add_character_pools
+
+
+add_character_pools = _get_add_character_pool_table()
+
+
+def _get_character_pools(password, mask=None):
+    if mask is None:
+        return masktools.get_character_pools(password)
+    return [masktools.get_character_pool_from_mask_code(mask_code) for mask_code in mask]
+
+
+def get_add_character_pools(character_pools):
+    bounded_pools = [None] + character_pools + [None]
+    return [add_character_pools[(bounded_pools[i], bounded_pools[i + 1])] for i in range(len(character_pools) + 1)]
+
+
+def iterate_mask_derivatives(password, mask=None):
+    character_pools = _get_character_pools(password, mask)
+    for i in range(len(password)):
+        prefix = password[:i]
+        suffix = password[i + 1:]
+        current_char = password[i]
+        for char in character_pools[i]:
+            if char != current_char:
+                yield prefix + char + suffix
+
+
+def iterate_add_derivatives(password, mask=None):
+    character_pools = get_add_character_pools(_get_character_pools(password, mask))
+    for i in range(len(password) + 1):
+        prefix = password[:i]
+        suffix = password[i:]
+        previous_char = password[i - 1] if i > 0 else None
+        for char in character_pools[i]:
+            # Inserting a repeat of the previous character was already produced one position earlier
+            if char != previous_char:
+                yield prefix + char + suffix
+
+
+def iterate_remove_derivatives(password):
+    for i in range(len(password)):
+        if i > 0 and password[i] == password[i - 1]:
             continue
-        derivative_builder = list(password)
-        derivative_builder[character_index] = char
-        derivative_set.add("".join(derivative_builder))
-    return derivative_set
+        yield password[:i] + password[i + 1:]
+
+
+def iterate_leet_derivatives(password, leet_policy=None):
+    return leetspeak.iterate_leet_permutations(password, leet_policy)
+
+
+def _is_mask_derivative(password, candidate, character_pools):
+    if len(candidate) != len(password):
+        return False
+    difference_index = -1
+    for i in range(len(password)):
+        if password[i] != candidate[i]:
+            if difference_index >= 0:
+                return False
+            difference_index = i
+    return candidate[difference_index] in character_pools[difference_index]
+
+
+def iterate_all_derivatives(password, mask=None, leet_policy=None):
+    character_pools = _get_character_pools(password, mask)
+    yield from iterate_mask_derivatives(password, mask)
+    yield from iterate_add_derivatives(password, mask)
+    yield from iterate_remove_derivatives(password)
+    for candidate in iterate_leet_derivatives(password, leet_policy):
+        if not _is_mask_derivative(password, candidate, character_pools):
+            yield candidate
+
+
+def _update_mask_derivatives(derivative_set, password, character_pools):
+    for i in range(len(password)):
+        character_pool = character_pools[i].replace(password[i], "")
+        derivative_set.update(map(str.join, character_pool, repeat((password[:i], password[i + 1:]))))
+
+
+def _update_add_derivatives(derivative_set, password, character_pools):
+    add_pools = get_add_character_pools(character_pools)
+    for i in range(len(password) + 1):
+        derivative_set.update(map(str.join, add_pools[i], repeat((password[:i], password[i:]))))
+
+
+def _update_all_derivatives(derivative_set, password, character_pools, leet_policy=None):
+    _update_mask_derivatives(derivative_set, password, character_pools)
+    _update_add_derivatives(derivative_set, password, character_pools)
+    derivative_set.update([password[:i] + password[i + 1:] for i in range(len(password))])
+    derivative_set.update(iterate_leet_derivatives(password, leet_policy))
 
 
 def get_mask_derivatives(password, mask=None):
-    if mask is None:
-        mask = masktools.get_mask(password)
     derivative_set = set()
-    for i in range(len(password)):
-        mask_code = mask[i]
-        character_pool = masktools.get_character_pool_from_mask_code(mask_code)
-        derivative_set = derivative_set | _generate_character_replace_derivatives(password, i, character_pool)
+    _update_mask_derivatives(derivative_set, password, _get_character_pools(password, mask))
     return derivative_set
 
 
 def get_add_derivatives(password, mask=None):
-    if mask is None:
-        mask = masktools.get_mask(password)
     derivative_set = set()
-    for i in range(len(password) + 1):
-        character_pool = ""
-        if i > 0:
-            character_pool = character_pool.join(masktools.get_character_pool_from_mask_code(mask[i - 1]))
-        if i < len(password):
-            character_pool = character_pool.join(masktools.get_character_pool_from_mask_code(mask[i]))
-        for char in character_pool:
-            derivative_builder = list(password)
-            derivative_builder.insert(i, char)
-            derivative_set.add("".join(derivative_builder))
+    _update_add_derivatives(derivative_set, password, _get_character_pools(password, mask))
     return derivative_set
 
 
 def get_remove_derivatives(password):
-    derivative_set = set()
-    for i in range(len(password)):
-        derivative_builder = list(password)
-        del derivative_builder[i]
-        derivative_set.add("".join(derivative_builder))
-    return derivative_set
+    return set(iterate_remove_derivatives(password))
+
+
+def get_leet_derivatives(password, leet_policy=None):
+    return set(iterate_leet_derivatives(password, leet_policy))
 
 
-def get_leet_derivatives(password):
+def get_all_derivatives(password, mask=None, leet_policy=None):
     derivative_set = set()
-    leet_generator = leetspeak.LeetGenerator(password)
-    while leet_generator.has_next:
-        derivative_set.add(leet_generator.get_next_permutation())
+    _update_all_derivatives(derivative_set, password, _get_character_pools(password, mask), leet_policy)
     return derivative_set
 
 
-def get_all_derivatives(password, mask=None):
-    if mask is None:
-        mask = masktools.get_mask(password)
+def get_batch_derivatives(password_batch, length_limit=None, leet_policy=None):
     derivative_set = set()
-    derivative_set.update(get_mask_derivatives(password, mask))
-    derivative_set.update(get_add_derivatives(password, mask))
-    derivative_set.update(get_remove_derivatives(password))
-    derivative_set.update(get_leet_derivatives(password))
+    for password in password_batch:
+        if length_limit is None or len(password) <= length_limit:
+            _update_all_derivatives(derivative_set, password, masktools.get_character_pools(password), leet_policy)
     return derivative_set
 
 
-def _is_trailing_digit(word, character_index):
-    for i in range(character_index, len(word)):
-        char = word[i]
+def _get_base_character_type(char):
+    char_type = _base_character_types.get(char)
+    if char_type is None:
         if char.isalpha():
-            return False
-    return True
-
-
-def _get_character_type(word, index):
-    char = word[index]
-    if char.isalpha():
-        if char.isupper():
-            return CHAR_UPPER
-        else:
-            return CHAR_LOWER
-    if char.isdigit():
-        if _is_trailing_digit(word, index):
-            return CHAR_DIGIT
+            char_type = CHAR_UPPER if char.isupper() else CHAR_LOWER
         elif leetspeak.is_possible_leet_substitution(char):
-            return CHAR_LEET
+            char_type = CHAR_LEET_DIGIT if char.isdigit() else CHAR_LEET
+        elif char.isdigit():
+            char_type = CHAR_DIGIT
         else:
-            return CHAR_DIGIT
-    if leetspeak.is_possible_leet_substitution(char):
-        return CHAR_LEET
-    return CHAR_OTHER
+            char_type = CHAR_OTHER
+        _base_character_types[char] = char_type
+    return char_type
+
+
+word_block_separator = "\n"
+_base_character_types = {word_block_separator: word_block_separator}
+ascii_character_types = str.maketrans({chr(i): _get_base_character_type(chr(i)) for i in range(128)})
+trailing_pattern = re.compile("[^%s%s%s]+$" % (CHAR_UPPER, CHAR_LOWER, word_block_separator), re.MULTILINE)
+# An all caps word keeps going through upper case letters, any other word through lower case letters
+word_pattern = re.compile("%(lower)s[%(lower)s%(leet)s]*|%(upper)s[%(leet)s]*(?:%(upper)s[%(upper)s%(leet)s]*|"
+                          "%(lower)s[%(lower)s%(leet)s]*)?" % {"lower": CHAR_LOWER, "upper": CHAR_UPPER,
+                                                               "leet": CHAR_LEET + CHAR_LEET_DIGIT})
+
+
+def _mark_trailing_digits(match):
+    return match.group().replace(CHAR_LEET_DIGIT, CHAR_DIGIT)
+
+
+def _get_character_types(passwords, separator_type=word_block_separator):
+    if passwords.isascii():
+        character_types = passwords.translate(ascii_character_types)
+    else:
+        character_types = "".join([_get_base_character_type(char) for char in passwords])
+    if separator_type != word_block_separator:
+        character_types = character_types.replace(word_block_separator, separator_type)
+    # Digits after the last letter are treated as digits rather than leetspeak
+    return trailing_pattern.sub(_mark_trailing_digits, character_types)
 
 
 def extract_words(password):
-    extracted_words = []
-    current_word = []
-    building_word = []
-    caps_detection_complete = False
-    is_all_caps = False
-    for i in range(len(password)):
-        char = password[i]
-        char_type = _get_character_type(password, i)
-        if building_word:
-            if not caps_detection_complete and char_type in (CHAR_UPPER, CHAR_LOWER):
-                caps_detection_complete = True
-                is_all_caps = (char_type == CHAR_UPPER)
-            if char_type == CHAR_LEET or \
-                    (char_type == CHAR_UPPER and is_all_caps) or \
-                    (char_type == CHAR_LOWER and not is_all_caps):
-                current_word.append(char)
-            else:
-                building_word = False
-                caps_detection_complete = False
-                is_all_caps = False
-                extracted_words.append("".join(current_word))
-                current_word.clear()
-        if not building_word and char_type in (CHAR_UPPER, CHAR_LOWER):
-            building_word = True
-            current_word.append(char)
-            if char_type == CHAR_LOWER:
-                caps_detection_complete = True
-    if building_word:
-        extracted_words.append("".join(current_word))
-    return extracted_words
+    return [password[match.start():match.end()]
+            for match in word_pattern.finditer(_get_character_types(password, CHAR_OTHER))]
+
+
+deleet_table = str.maketrans(leetspeak.reverse_leet_dict)
 
 
 def _normalize_word(word):
+    if word.isascii():
+        return word.lower().translate(deleet_table)
     word_builder = []
     for char in word:
         if char.islower():
@@ -147,42 +211,82 @@ def _normalize_word(word):
     return "".join(word_builder)
 
 
+def extract_normalized_words(password, minimum_word_size=3):
+    return [_normalize_word(word) for word in extract_words(password) if len(word) >= minimum_word_size]
+
+
+variant_tracking_factor = 4
+
+
 class WordExtractor:
-    def __init__(self):
+    def __init__(self, max_variants=None):
         self.extracted_word_count = {}
         self.extracted_word_variants = {}
+        self.max_variants = max_variants
 
     def extract(self, password, minimum_word_size=3):
-        words = extract_words(password)
-        for word in words:
-            if len(word) < minimum_word_size:
+        self.extract_many((password,), minimum_word_size)
+
+    def extract_many(self, passwords, minimum_word_size=3, occurrences=1):
+        block = word_block_separator.join(passwords)
+        if block.count(word_block_separator) != len(passwords) - 1:
+            for password in passwords:
+                for word in extract_words(password):
+                    if len(word) >= minimum_word_size:
+                        self._add_word(_normalize_word(word), word, occurrences)
+            return
+        normalized_block = _normalize_word(block)
+        if len(normalized_block) != len(block):
+            normalized_block = None
+        for match in word_pattern.finditer(_get_character_types(block)):
+            word_start, word_end = match.span()
+            if word_end - word_start < minimum_word_size:
                 continue
-            normalized_word = _normalize_word(word)
-            self._add_to_word_count(normalized_word)
-            self._add_variant(normalized_word, word)
-
-    def _add_to_word_count(self, normalized_word):
-        if normalized_word in self.extracted_word_count.keys():
-            count = self.extracted_word_count.get(normalized_word)
-            self.extracted_word_count[normalized_word] = count + 1
-        else:
-            self.extracted_word_count[normalized_word] = 1
+            if normalized_block is None:
+                normalized_word = _normalize_word(block[word_start:word_end])
+            else:
+                normalized_word = normalized_block[word_start:word_end]
+            self._add_word(normalized_word, block[word_start:word_end], occurrences)
+
+    def _add_word(self, normalized_word, word, occurrences=1):
+        self.extracted_word_count[normalized_word] = self.extracted_word_count.get(normalized_word, 0) + occurrences
+        self._add_variant(normalized_word, word, occurrences)
 
-    def _add_variant(self, normalized_word, variant):
-        if normalized_word in self.extracted_word_variants.keys():
-            variant_list = self.extracted_word_variants[normalized_word]
-            if variant not in variant_list:
-                variant_list.append(variant)
+    def _add_variant(self, normalized_word, variant, occurrences=1):
+        variants = self.extracted_word_variants.get(normalized_word)
+        if variants is None:
+            self.extracted_word_variants[normalized_word] = {variant: occurrences}
+        elif variant in variants:
+            variants[variant] += occurrences
+        elif self.max_variants is None or len(variants) < self.max_variants * variant_tracking_factor:
+            variants[variant] = occurrences
         else:
-            self.extracted_word_variants[normalized_word] = [variant]
+            # Space saving: a new spelling replaces the least common tracked one and inherits its count
+            least_common_variant = min(variants, key=variants.get)
+            variants[variant] = variants.pop(least_common_variant) + occurrences
+
+    def merge(self, other):
+        for normalized_word, count in other.extracted_word_count.items():
+            self.extracted_word_count[normalized_word] = self.extracted_word_count.get(normalized_word, 0) + count
+        for normalized_word, variants in other.extracted_word_variants.items():
+            for variant, occurrences in variants.items():
+                self._add_variant(normalized_word, variant, occurrences)
 
     def get_ordered_common_words(self):
         words_ordered = [(v, k) for k, v in self.extracted_word_count.items()]
         words_ordered.sort(reverse=True)
         return words_ordered
 
+    def iterate_word_variants(self):
+        for normalized_word in self.extracted_word_variants:
+            for variant in self.get_variants(normalized_word):
+                yield normalized_word, variant
+
     def get_variants(self, word):
-        return tuple(self.extracted_word_variants[word])
+        variants = self.extracted_word_variants[word]
+        if self.max_variants is None:
+            return tuple(variants)
+        return tuple(variant for variant, occurrences in Counter(variants).most_common(self.max_variants))
 
     def clear(self):
         self.extracted_word_count.clear()
@@ -0,0 +1,277 @@
+import heapq
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+from array import array
+from collections import Counter
+from itertools import groupby, islice
+from analyzertools import masktools, passwordtools, potreader
+from analyzertools.dedupstore import iterate_run
+
+file_magic = b"PACACHE4"
+# magic, entry count, password count, plaintext blob size, mask code blob size, summary size, potfile size,
+# potfile mtime, hash fields
+header_format = "<8sQQQQQQqq"
+header_size = struct.calcsize(header_format)
+cache_suffix = ".pacache"
+entry_separator = b"\n"
+mask_code_block_size = 4096
+analysis_block_size = 4096
+default_chunk_size = 1000000
+# offsets, mask offsets and counts are aligned columns, followed by the plaintext and mask code blobs
+column_part_count = 3
+part_count = 5
+
+
+def get_cache_filename(potfile_name):
+    return potfile_name + cache_suffix
+
+
+def get_potfile_signature(potfile_name):
+    potfile_stat = os.stat(potfile_name)
+    return potfile_stat.st_size, potfile_stat.st_mtime_ns
+
+
+def _align(size):
+    return (size + 7) // 8 * 8
+
+
+def _get_entry_occurrences(entry):
+    return entry[1]
+
+
+def analyze_weighted_block(passwords, mask_codes, counts, word_extractor, masks, literal_fragments):
+    # Each unique plaintext is analyzed once and weighted by how often it occurs in the potfile, in first seen
+    # order so word variants are listed as a potfile parse lists them
+    for occurrences, entries in groupby(zip(passwords, counts), key=_get_entry_occurrences):
+        password_group = [password for password, _ in entries]
+        word_extractor.extract_many(password_group, occurrences=occurrences)
+        masktools.count_literal_fragments(password_group, literal_fragments, weight=occurrences)
+    for mask_code, occurrences in zip(mask_codes, counts):
+        masks[masktools.pack_mask_code(mask_code)] += occurrences
+
+
+def _write_entry_run(entries, temp_dir):
+    handle, path = tempfile.mkstemp(prefix="potanalyzer_", suffix=".run", dir=temp_dir)
+    with os.fdopen(handle, "w", encoding="utf-8", newline="\n") as run_file:
+        for first_index, occurrences, plaintext in entries:
+            run_file.write("%d\t%d\t%s\n" % (first_index, occurrences, plaintext))
+    return path
+
+
+def _iterate_entry_run(path):
+    for line in iterate_run(path):
+        first_index, occurrences, plaintext = line.split("\t", 2)
+        yield int(first_index), int(occurrences), plaintext
+
+
+def _get_entry_plaintext(entry):
+    return entry[2]
+
+
+def _iterate_ordered_entries(run_paths, chunk_size, temp_dir):
+    # Runs are sorted by plaintext to merge repeated plaintexts, then sorted again into first seen order
+    ordered_paths = []
+    try:
+        chunk = []
+        entries = heapq.merge(*[_iterate_entry_run(path) for path in run_paths], key=_get_entry_plaintext)
+        for plaintext, plaintext_entries in groupby(entries, key=_get_entry_plaintext):
+            plaintext_entries = list(plaintext_entries)
+            chunk.append((min(entry[0] for entry in plaintext_entries),
+                          sum(entry[1] for entry in plaintext_entries), plaintext))
+            if len(chunk) >= chunk_size:
+                chunk.sort()
+                ordered_paths.append(_write_entry_run(chunk, temp_dir))
+                chunk = []
+        chunk.sort()
+        for first_index, occurrences, plaintext in heapq.merge(*[_iterate_entry_run(path) for path in ordered_paths],
+                                                               chunk):
+            yield plaintext, occurrences
+    finally:
+        for path in ordered_paths:
+            os.remove(path)
+
+
+def _analyze_block(password_block, word_extractor, masks, literal_fragments):
+    word_extractor.extract_many(password_block)
+    masktools.count_mask_codes(password_block, masks)
+    masktools.count_literal_fragments(password_block, literal_fragments)
+
+
+def _write_entries(sorted_counts, part_files):
+    offsets_file, mask_offsets_file, counts_file, blob_file, mask_blob_file = part_files
+    entry_count = 0
+    blob_size = 0
+    mask_blob_size = 0
+    array("Q", [0]).tofile(offsets_file)
+    array("Q", [0]).tofile(mask_offsets_file)
+    sorted_counts = iter(sorted_counts)
+    while True:
+        entries = list(islice(sorted_counts, mask_code_block_size))
+        if len(entries) == 0:
+            break
+        plaintexts = [plaintext for plaintext, occurrences in entries]
+        offsets = array("Q")
+        mask_offsets = array("Q")
+        for plaintext, mask_code in zip(plaintexts, masktools.get_mask_codes(plaintexts)):
+            encoded_plaintext = plaintext.encode("utf-8")
+            blob_file.write(encoded_plaintext)
+            blob_file.write(entry_separator)
+            mask_blob_file.write(mask_code)
+            mask_blob_file.write(entry_separator)
+            blob_size += len(encoded_plaintext) + 1
+            mask_blob_size += len(mask_code) + 1
+            offsets.append(blob_size)
+            mask_offsets.append(mask_blob_size)
+        offsets.tofile(offsets_file)
+        mask_offsets.tofile(mask_offsets_file)
+        array("I", [occurrences for plaintext, occurrences in entries]).tofile(counts_file)
+        entry_count += len(entries)
+    return entry_count, blob_size, mask_blob_size
+
+
+def build_cache(potfile_name, cache_name, hash_fields=None, temp_dir=None, chunk_size=default_chunk_size):
+    potfile_size, potfile_mtime = get_potfile_signature(potfile_name)
+    reader = potreader.PotfileReader(potfile_name)
+    # The summary is analyzed in potfile order, so importing it matches parsing the potfile itself
+    word_extractor = passwordtools.WordExtractor()
+    masks = Counter()
+    literal_fragments = masktools.FragmentCounter()
+    plaintext_entries = {}
+    password_count = 0
+    password_block = []
+    run_paths = []
+    part_paths = []
+    try:
+        chunk_offsets = potreader.get_chunk_offsets(potfile_name)
+        for plaintext in reader.iterate_plaintexts(hash_fields=hash_fields, chunk_offsets=chunk_offsets):
+            if plaintext is None:
+                _analyze_block(password_block, word_extractor, masks, literal_fragments)
+                password_block = []
+                literal_fragments.prune()
+                continue
+            password_block.append(plaintext)
+            if len(password_block) >= analysis_block_size:
+                _analyze_block(password_block, word_extractor, masks, literal_fragments)
+                password_block = []
+            entry = plaintext_entries.get(plaintext)
+            if entry is None:
+                plaintext_entries[plaintext] = [password_count, 1]
+            else:
+                entry[1] += 1
+            password_count += 1
+            # Unique plaintexts are spilled as sorted runs so the build never holds the whole potfile
+            if len(plaintext_entries) >= chunk_size:
+                run_paths.append(_write_entry_run(((first_index, occurrences, plaintext) for plaintext,
+                                                   (first_index, occurrences) in sorted(plaintext_entries.items())),
+                                                  temp_dir))
+                plaintext_entries.clear()
+        _analyze_block(password_block, word_extractor, masks, literal_fragments)
+        literal_fragments.prune()
+        if len(run_paths) == 0:
+            ordered_entries = ((plaintext, entry[1]) for plaintext, entry in plaintext_entries.items())
+        else:
+            run_paths.append(_write_entry_run(((first_index, occurrences, plaintext) for plaintext,
+                                               (first_index, occurrences) in sorted(plaintext_entries.items())),
+                                              temp_dir))
+            plaintext_entries.clear()
+            ordered_entries = _iterate_ordered_entries(run_paths, chunk_size, temp_dir)
+        part_files = []
+        try:
+            for _ in range(part_count):
+                handle, path = tempfile.mkstemp(prefix="potanalyzer_", suffix=".part", dir=temp_dir)
+                part_paths.append(path)
+                part_files.append(os.fdopen(handle, "wb"))
+            entry_count, blob_size, mask_blob_size = _write_entries(ordered_entries, part_files)
+        finally:
+            for part_file in part_files:
+                part_file.close()
+        summary = pickle.dumps((masks, literal_fragments, word_extractor), pickle.HIGHEST_PROTOCOL)
+        temporary_name = cache_name + ".tmp"
+        with open(temporary_name, "wb") as cache_file:
+            cache_file.write(struct.pack(header_format, file_magic, entry_count, password_count, blob_size,
+                                         mask_blob_size, len(summary), potfile_size, potfile_mtime,
+                                         -1 if hash_fields is None else hash_fields))
+            for i, path in enumerate(part_paths):
+                with open(path, "rb") as part_file:
+                    shutil.copyfileobj(part_file, cache_file)
+                if i < column_part_count:
+                    part_size = os.path.getsize(path)
+                    cache_file.write(b"\0" * (_align(part_size) - part_size))
+            cache_file.write(summary)
+        os.replace(temporary_name, cache_name)
+    finally:
+        for path in run_paths + part_paths:
+            if os.path.exists(path):
+                os.remove(path)
+    return entry_count, password_count, reader
+
+
+class PotfileCache:
+    def __init__(self, cache_name):
+        with open(cache_name, "rb") as cache_file:
+            self._mapping = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mapping) < header_size or self._mapping[:len(file_magic)] != file_magic:
+            self._mapping.close()
+            raise ValueError("'%s' is not a PotAnalyzer cache file" % cache_name)
+        magic, self.entry_count, self.password_count, blob_size, mask_blob_size, summary_size, self.potfile_size, \
+            self.potfile_mtime, hash_fields = struct.unpack(header_format, self._mapping[:header_size])
+        column_sizes = [_align((self.entry_count + 1) * 8)] * 2 + [_align(self.entry_count * 4)]
+        if header_size + sum(column_sizes) + blob_size + mask_blob_size + summary_size > len(self._mapping):
+            self._mapping.close()
+            raise ValueError("'%s' is a truncated PotAnalyzer cache file" % cache_name)
+        self.hash_fields = None if hash_fields < 0 else hash_fields
+        self._view = memoryview(self._mapping)
+        position = header_size
+        columns = []
+        for type_code, item_count in (("Q", self.entry_count + 1), ("Q", self.entry_count + 1),
+                                      ("I", self.entry_count)):
+            column_size = item_count * array(type_code).itemsize
+            columns.append(self._view[position:position + column_size].cast(type_code))
+            position += _align(column_size)
+        self.offsets, self.mask_offsets, self.counts = columns
+        self.blob = self._view[position:position + blob_size]
+        position += blob_size
+        self.mask_blob = self._view[position:position + mask_blob_size]
+        position += mask_blob_size
+        self.summary = self._view[position:position + summary_size]
+
+    def matches_potfile(self, potfile_name, hash_fields=None):
+        try:
+            return get_potfile_signature(potfile_name) == (self.potfile_size, self.potfile_mtime) and \
+                self.hash_fields == hash_fields
+        except IOError:
+            return False
+
+    def get_plaintext(self, index):
+        return str(self.blob[self.offsets[index]:self.offsets[index + 1] - 1], "utf-8")
+
+    def get_mask_code(self, index):
+        return bytes(self.mask_blob[self.mask_offsets[index]:self.mask_offsets[index + 1] - 1])
+
+    def iterate_blocks(self, block_size):
+        # Entries are newline separated, so a whole block decodes and splits in one go
+        for start in range(0, self.entry_count, block_size):
+            stop = min(start + block_size, self.entry_count)
+            plaintexts = str(self.blob[self.offsets[start]:self.offsets[stop] - 1], "utf-8").split("\n")
+            mask_codes = bytes(self.mask_blob[self.mask_offsets[start]:self.mask_offsets[stop] - 1]).split(b"\n")
+            yield plaintexts, mask_codes, self.counts[start:stop].tolist()
+
+    def iterate_plaintext_blocks(self, block_size):
+        for start in range(0, self.entry_count, block_size):
+            stop = min(start + block_size, self.entry_count)
+            yield str(self.blob[self.offsets[start]:self.offsets[stop] - 1], "utf-8").split("\n")
+
+    def load_summary(self):
+        return pickle.loads(self.summary)
+
+    def close(self):
+        if self._mapping is not None:
+            for view in (self.offsets, self.mask_offsets, self.counts, self.blob, self.mask_blob, self.summary,
+                         self._view):
+                view.release()
+            self._mapping.close()
+            self._mapping = None
@@ -0,0 +1,170 @@
+import os
+import time
+from datetime import timedelta
+
+default_chunk_size = 1024 * 1024
+analysis_chunk_size = 4 * 1024 * 1024
+hex_prefix = b"$HEX["
+hex_suffix = b"]"
+hash_separator = b":"
+
+
+def decode_plaintext(raw_plaintext):
+    if raw_plaintext.startswith(hex_prefix) and raw_plaintext.endswith(hex_suffix):
+        try:
+            raw_plaintext = bytes.fromhex(raw_plaintext[len(hex_prefix):-len(hex_suffix)].decode("ascii"))
+        except ValueError:
+            pass
+    try:
+        return raw_plaintext.decode("utf-8")
+    except UnicodeDecodeError:
+        return raw_plaintext.decode("latin-1")
+
+
+def get_plaintext(line, require_hash=True, hash_fields=None):
+    if hash_fields is None:
+        hash_value, separator, raw_plaintext = line.strip().rpartition(hash_separator)
+    else:
+        # Everything after the hash fields is the plaintext, even when it contains the separator itself
+        fields = line.strip().split(hash_separator, hash_fields)
+        separator = hash_separator if len(fields) > hash_fields else b""
+        raw_plaintext = fields[-1]
+    if require_hash and len(separator) == 0:
+        return None
+    if len(raw_plaintext) == 0:
+        return None
+    plaintext = decode_plaintext(raw_plaintext)
+    if "\n" in plaintext or "\r" in plaintext:
+        return None
+    return plaintext
+
+
+def _get_line_offsets(potfile, start_offset, target_offsets):
+    file_size = potfile.seek(0, os.SEEK_END)
+    line_offsets = [start_offset]
+    for target_offset in target_offsets:
+        if target_offset <= line_offsets[-1]:
+            continue
+        if target_offset >= file_size:
+            break
+        potfile.seek(target_offset - 1)
+        potfile.readline()
+        line_offset = potfile.tell()
+        if line_offset >= file_size:
+            break
+        if line_offset > line_offsets[-1]:
+            line_offsets.append(line_offset)
+    return line_offsets
+
+
+def get_shard_offsets(filename, shard_count, start_offset=0):
+    with open(filename, "rb") as potfile:
+        file_size = potfile.seek(0, os.SEEK_END)
+        shard_size = max((file_size - start_offset) // max(shard_count, 1), 1)
+        return _get_line_offsets(potfile, start_offset, [start_offset + shard_index * shard_size
+                                                         for shard_index in range(1, shard_count)])
+
+
+def get_chunk_offsets(filename, chunk_size=analysis_chunk_size, start_offset=0):
+    # Line aligned offsets every chunk_size bytes, the same whether the potfile is read serially or in shards
+    with open(filename, "rb") as potfile:
+        file_size = potfile.seek(0, os.SEEK_END)
+        return _get_line_offsets(potfile, start_offset, range(start_offset + chunk_size, file_size, chunk_size))[1:]
+
+
+class PotfileReader:
+    def __init__(self, filename, chunk_size=default_chunk_size, start_offset=0, include_partial_line=True,
+                 stop_offset=None):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.start_offset = start_offset
+        self.stop_offset = stop_offset
+        self.include_partial_line = include_partial_line
+        self.end_offset = start_offset
+        self.bytes_read = 0
+        self.start_time = None
+        self.end_time = None
+
+    def iterate_lines(self, chunk_offsets=None):
+        self.start_time = time.time()
+        chunk_offsets = iter(chunk_offsets or ())
+        next_chunk_offset = next(chunk_offsets, None)
+        with open(self.filename, "rb") as potfile:
+            potfile.seek(self.start_offset)
+            remainder = b""
+            while True:
+                read_size = self.chunk_size
+                if self.stop_offset is not None:
+                    read_size = min(read_size, self.stop_offset - self.start_offset - self.bytes_read)
+                if read_size <= 0:
+                    break
+                chunk = potfile.read(read_size)
+                if len(chunk) == 0:
+                    break
+                self.bytes_read += len(chunk)
+                lines = (remainder + chunk).split(b"\n")
+                remainder = lines.pop()
+                line_offset = self.end_offset
+                self.end_offset = self.start_offset + self.bytes_read - len(remainder)
+                if next_chunk_offset is None or next_chunk_offset >= self.end_offset:
+                    yield from lines
+                    continue
+                # None marks where a chunk ends, only read chunks holding a chunk offset track line offsets
+                for line in lines:
+                    while next_chunk_offset is not None and next_chunk_offset <= line_offset:
+                        yield None
+                        next_chunk_offset = next(chunk_offsets, None)
+                    yield line
+                    line_offset += len(line) + 1
+            if len(remainder) > 0 and self.include_partial_line:
+                if next_chunk_offset is not None and next_chunk_offset <= self.end_offset:
+                    yield None
+                self.end_offset += len(remainder)
+                yield remainder
+        self.end_time = time.time()
+
+    def iterate_words(self):
+        for line in self.iterate_lines():
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            yield line.decode("utf-8")
+
+    def count_lines(self):
+        line_count = 0
+        ends_with_newline = True
+        with open(self.filename, "rb") as potfile:
+            while True:
+                chunk = potfile.read(self.chunk_size)
+                if len(chunk) == 0:
+                    break
+                line_count += chunk.count(b"\n")
+                ends_with_newline = chunk.endswith(b"\n")
+        if not ends_with_newline:
+            line_count += 1
+        return line_count
+
+    def iterate_plaintexts(self, require_hash=True, hash_fields=None, chunk_offsets=None):
+        for line in self.iterate_lines(chunk_offsets):
+            if line is None:
+                yield None
+                continue
+            plaintext = get_plaintext(line, require_hash, hash_fields)
+            if plaintext is not None:
+                yield plaintext
+
+    def elapsed_seconds(self):
+        if self.start_time is None:
+            return 0.0
+        end_time = self.end_time if self.end_time is not None else time.time()
+        return end_time - self.start_time
+
+    def bytes_per_second(self):
+        elapsed = self.elapsed_seconds()
+        if elapsed > 0:
+            return self.bytes_read / elapsed
+        return 0.0
+
+    def get_throughput_str(self):
+        return "%.2f MB in %s (%.2f MB/s)" % (self.bytes_read / 1048576.0,
+                                               str(timedelta(seconds=round(self.elapsed_seconds(), 2))),
+                                               self.bytes_per_second() / 1048576.0)
@@ -0,0 +1,103 @@
+import cProfile
+import json
+import time
+from contextlib import contextmanager
+
+# resource is Unix only, peak RSS is reported as unavailable elsewhere
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def get_peak_rss_kb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class StageStats:
+    def __init__(self, name, items_in=None):
+        self.name = name
+        self.items_in = items_in
+        self.items_out = None
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_kb = None
+        self.peak_rss_growth_kb = None
+
+    def throughput(self):
+        items = self.items_in if self.items_in is not None else self.items_out
+        if items is None or self.wall_seconds <= 0:
+            return None
+        return items / self.wall_seconds
+
+    def to_dict(self):
+        return {"name": self.name,
+                "wall_seconds": self.wall_seconds,
+                "cpu_seconds": self.cpu_seconds,
+                "peak_rss_kb": self.peak_rss_kb,
+                "peak_rss_growth_kb": self.peak_rss_growth_kb,
+                "items_in": self.items_in,
+                "items_out": self.items_out,
+                "items_per_second": self.throughput()}
+
+
+class PipelineProfiler:
+    def __init__(self):
+        self.stages = []
+        self.profile_name = None
+        self.profile = None
+
+    def enable_profile(self, profile_name):
+        self.profile_name = profile_name
+        self.profile = cProfile.Profile()
+
+    @contextmanager
+    def stage(self, name, items_in=None):
+        stage_stats = StageStats(name, items_in)
+        start_rss_kb = get_peak_rss_kb()
+        start_time = time.perf_counter()
+        start_cpu_time = time.process_time()
+        try:
+            yield stage_stats
+        finally:
+            stage_stats.wall_seconds = time.perf_counter() - start_time
+            stage_stats.cpu_seconds = time.process_time() - start_cpu_time
+            stage_stats.peak_rss_kb = get_peak_rss_kb()
+            if stage_stats.peak_rss_kb is not None:
+                stage_stats.peak_rss_growth_kb = stage_stats.peak_rss_kb - start_rss_kb
+            self.stages.append(stage_stats)
+
+    @contextmanager
+    def profiled(self):
+        if self.profile is None:
+            yield
+            return
+        self.profile.enable()
+        try:
+            yield
+        finally:
+            self.profile.disable()
+
+    def write_profile(self):
+        if self.profile is not None:
+            self.profile.dump_stats(self.profile_name)
+
+    def write_json(self, filename):
+        with open(filename, "w") as stats_file:
+            json.dump({"stages": [stage_stats.to_dict() for stage_stats in self.stages],
+                       "peak_rss_kb": get_peak_rss_kb()}, stats_file, indent=2)
+
+    def get_summary_lines(self):
+        lines = ["%-32s %10s %10s %12s %12s %12s %14s" % ("Stage", "Wall (s)", "CPU (s)", "Peak RSS KB",
+                                                          "Items in", "Items out", "Items/s")]
+        for stage_stats in self.stages:
+            throughput = stage_stats.throughput()
+            lines.append("%-32s %10.2f %10.2f %12s %12s %12s %14s" % (
+                stage_stats.name, stage_stats.wall_seconds, stage_stats.cpu_seconds,
+                "-" if stage_stats.peak_rss_kb is None else str(stage_stats.peak_rss_kb),
+                "-" if stage_stats.items_in is None else str(stage_stats.items_in),
+                "-" if stage_stats.items_out is None else str(stage_stats.items_out),
+                "-" if throughput is None else "%.0f" % throughput))
+        return lines
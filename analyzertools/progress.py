@@ -0,0 +1,77 @@
+import sys
+import threading
+import time
+from datetime import timedelta
+
+default_tty_interval = 0.5
+default_log_interval = 30.0
+
+
+def format_time_remaining(completed, total, rows_per_second):
+    if rows_per_second <= 0 or total <= completed:
+        return "Unknown" if total > completed else str(timedelta(seconds=0))
+    return str(timedelta(seconds=round((total - completed) / rows_per_second)))
+
+
+class ProgressReporter:
+    def __init__(self, name, prefix_comment, total, completed=0, stream=None, interval=None):
+        self.name = name
+        self.prefix_comment = prefix_comment
+        self.total = total
+        self.start_completed = completed
+        self.completed = completed
+        self.derivatives = 0
+        self.stream = stream if stream is not None else sys.stdout
+        self.is_tty = hasattr(self.stream, "isatty") and self.stream.isatty()
+        if interval is None:
+            interval = default_tty_interval if self.is_tty else default_log_interval
+        self.interval = interval
+        self.start_time = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def update(self, rows, derivatives=0):
+        self.completed += rows
+        self.derivatives += derivatives
+
+    def start(self):
+        self.start_time = time.time()
+        self._thread = threading.Thread(target=self._run, name="progress-" + self.name, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._render(final=True)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self._render()
+
+    def _render(self, final=False):
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        completed = self.completed
+        rows_per_second = (completed - self.start_completed) / elapsed
+        derivatives_per_second = self.derivatives / elapsed
+        percent = (float(completed) / float(self.total)) * 100 if self.total > 0 else 100.0
+        time_left = format_time_remaining(completed, self.total, rows_per_second)
+        if self.is_tty:
+            self.stream.write("\r%s %d/%d (%.2f%%) %.0f rows/s %.0f derivatives/s Estimated time remaining: %s   " %
+                              (self.prefix_comment, completed, self.total, percent, rows_per_second,
+                               derivatives_per_second, time_left))
+            if final:
+                self.stream.write("\n")
+        else:
+            self.stream.write("progress stage=%s rows=%d total=%d percent=%.2f rows_per_second=%.1f "
+                              "derivatives_per_second=%.1f eta=%s%s\n" %
+                              (self.name, completed, self.total, percent, rows_per_second, derivatives_per_second,
+                               time_left, " done" if final else ""))
+        self.stream.flush()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
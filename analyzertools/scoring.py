@@ -0,0 +1,208 @@
+import heapq
+import math
+import os
+import tempfile
+from itertools import repeat
+from analyzertools import masktools, passwordtools
+
+EDIT_ORIGINAL = "original"
+EDIT_MASK = "mask"
+EDIT_ADD = "add"
+EDIT_REMOVE = "remove"
+EDIT_LEET = "leet"
+
+edit_type_weights = {EDIT_ORIGINAL: 1.0,
+                     EDIT_MASK: 0.5,
+                     EDIT_REMOVE: 0.4,
+                     EDIT_ADD: 0.3,
+                     EDIT_LEET: 0.2}
+default_depth_decay = 0.1
+default_sort_run_size = 1000000
+sort_entry_overhead = 230
+no_scores = (-math.inf, -math.inf)
+
+worker_scorer = None
+
+
+class CandidateScorer:
+    def __init__(self, masks, word_counts, depth_decay=default_depth_decay):
+        self.masks = masks
+        self.word_counts = word_counts
+        self.log_depth_decay = math.log(depth_decay)
+
+    def get_edit_score(self, edit_type, depth):
+        return math.log(edit_type_weights[edit_type]) + depth * self.log_depth_decay
+
+    def _score_many(self, candidates, edit_scores):
+        masks = self.masks
+        word_counts = self.word_counts
+        for candidate, edit_score, mask_code in zip(candidates, edit_scores, masktools.get_mask_codes(candidates)):
+            word_count = 0
+            for normalized_word in passwordtools.extract_normalized_words(candidate):
+                word_count = max(word_count, word_counts.get(normalized_word, 0))
+            mask_count = masks.get(masktools.pack_mask_code(mask_code), 0)
+            # The edit score travels with the total so incremental runs can store it without recomputing it
+            yield candidate, (edit_score + math.log(mask_count + 1) + math.log(word_count + 1), edit_score)
+
+    def score_many(self, candidates, edit_type, depth):
+        return self._score_many(candidates, repeat(self.get_edit_score(edit_type, depth)))
+
+    def rescore_many(self, edit_scored_candidates):
+        candidates = [candidate for candidate, edit_score in edit_scored_candidates]
+        return self._score_many(candidates, [edit_score for candidate, edit_score in edit_scored_candidates])
+
+
+def set_worker_scorer(scorer):
+    global worker_scorer
+    worker_scorer = scorer
+
+
+def get_batch_scored_derivatives(password_batch, depth, length_limit=None, leet_policy=None):
+    scored_derivatives = {}
+    for password in password_batch:
+        if length_limit is not None and len(password) > length_limit:
+            continue
+        mask = masktools.get_mask(password)
+        for edit_type, candidates in ((EDIT_MASK, passwordtools.iterate_mask_derivatives(password, mask)),
+                                      (EDIT_ADD, passwordtools.iterate_add_derivatives(password, mask)),
+                                      (EDIT_REMOVE, passwordtools.iterate_remove_derivatives(password)),
+                                      (EDIT_LEET, passwordtools.iterate_leet_derivatives(password, leet_policy))):
+            for candidate, scores in worker_scorer.score_many(list(candidates), edit_type, depth):
+                if scores[0] > scored_derivatives.get(candidate, no_scores)[0]:
+                    scored_derivatives[candidate] = scores
+    return scored_derivatives
+
+
+def _write_scored_candidates(run_file, scored_candidates):
+    candidate_count = 0
+    for score, candidate in scored_candidates:
+        run_file.write("%r\t%s\n" % (score, candidate))
+        candidate_count += 1
+    return candidate_count
+
+
+def write_scored_file(path, scored_candidates):
+    with open(path, "w", encoding="utf-8", newline="\n") as run_file:
+        return _write_scored_candidates(run_file, scored_candidates)
+
+
+def iterate_scored_run(path):
+    with open(path, "r", encoding="utf-8", newline="\n") as run_file:
+        for line in run_file:
+            score, _, candidate = line[:-1].partition("\t")
+            yield float(score), candidate
+
+
+def _write_prioritized_candidates(run_file, prioritized_candidates):
+    for score, edit_score, candidate in prioritized_candidates:
+        run_file.write("%r\t%r\t%s\n" % (score, edit_score, candidate))
+
+
+def write_prioritized_run(prioritized_candidates, temp_dir=None):
+    handle, path = tempfile.mkstemp(prefix="potanalyzer_", suffix=".scored", dir=temp_dir)
+    with os.fdopen(handle, "w", encoding="utf-8", newline="\n") as run_file:
+        _write_prioritized_candidates(run_file, prioritized_candidates)
+    return path
+
+
+def iterate_prioritized_run(path):
+    with open(path, "r", encoding="utf-8", newline="\n") as run_file:
+        for line in run_file:
+            score, edit_score, candidate = line[:-1].split("\t", 2)
+            yield float(score), float(edit_score), candidate
+
+
+def _candidate_key(scored_candidate):
+    return scored_candidate[-1]
+
+
+def _priority_key(scored_candidate):
+    return -scored_candidate[0], scored_candidate[-1]
+
+
+def _merge_best_entries(scored_runs):
+    # Entries hold their scores before the candidate, so comparing entries of one candidate compares the scores
+    current_entry = None
+    for entry in heapq.merge(*scored_runs, key=_candidate_key):
+        if current_entry is None or entry[-1] != current_entry[-1]:
+            if current_entry is not None:
+                yield current_entry
+            current_entry = entry
+        elif entry > current_entry:
+            current_entry = entry
+    if current_entry is not None:
+        yield current_entry
+
+
+def merge_best_scores(scored_runs):
+    for score, candidate in _merge_best_entries(scored_runs):
+        yield candidate, score
+
+
+class PrioritizedCandidates:
+    def __init__(self, run_size=default_sort_run_size, temp_dir=None):
+        self.run_size = run_size
+        self.temp_dir = temp_dir
+        self.best_scores = {}
+        self.run_paths = []
+
+    def add_many(self, scored_candidates):
+        best_scores = self.best_scores
+        for candidate, scores in scored_candidates:
+            if scores[0] > best_scores.get(candidate, no_scores)[0]:
+                best_scores[candidate] = scores
+        if len(best_scores) >= self.run_size:
+            self.run_paths.append(write_prioritized_run(self._iterate_buffer(_candidate_key), self.temp_dir))
+            best_scores.clear()
+
+    def _iterate_buffer(self, key):
+        return sorted(((score, edit_score, candidate) for candidate, (score, edit_score) in self.best_scores.items()),
+                      key=key)
+
+    def _iterate_unique(self):
+        if len(self.run_paths) == 0:
+            for candidate, (score, edit_score) in self.best_scores.items():
+                yield score, edit_score, candidate
+            return
+        runs = [iterate_prioritized_run(path) for path in self.run_paths]
+        runs.append(self._iterate_buffer(_candidate_key))
+        yield from _merge_best_entries(runs)
+
+    def iterate_edit_scores(self):
+        if len(self.run_paths) == 0:
+            return ((candidate, edit_score) for candidate, (score, edit_score) in sorted(self.best_scores.items()))
+        return ((candidate, edit_score) for score, edit_score, candidate in self._iterate_unique())
+
+    def iterate_ordered(self, max_candidates=None):
+        unique_candidates = self._iterate_unique()
+        if max_candidates is not None:
+            for score, edit_score, candidate in heapq.nsmallest(max_candidates, unique_candidates, key=_priority_key):
+                yield candidate
+            return
+        if len(self.run_paths) == 0:
+            for score, edit_score, candidate in self._iterate_buffer(_priority_key):
+                yield candidate
+            return
+        ordered_paths = []
+        try:
+            buffer = []
+            for prioritized_candidate in unique_candidates:
+                buffer.append(prioritized_candidate)
+                if len(buffer) >= self.run_size:
+                    buffer.sort(key=_priority_key)
+                    ordered_paths.append(write_prioritized_run(buffer, self.temp_dir))
+                    buffer = []
+            buffer.sort(key=_priority_key)
+            runs = [iterate_prioritized_run(path) for path in ordered_paths]
+            runs.append(buffer)
+            for score, edit_score, candidate in heapq.merge(*runs, key=_priority_key):
+                yield candidate
+        finally:
+            for path in ordered_paths:
+                os.remove(path)
+
+    def close(self):
+        self.best_scores.clear()
+        for path in self.run_paths:
+            os.remove(path)
+        self.run_paths = []
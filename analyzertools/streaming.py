@@ -0,0 +1,78 @@
+import os
+import sys
+import tempfile
+from analyzertools import bloomfilter, potreader
+
+stdout_target = "-"
+default_stream_capacity = 50000000
+
+
+def open_stream_output(target, stdout=None):
+    if target == stdout_target:
+        return (stdout if stdout is not None else sys.stdout).buffer
+    return open(target, "wb")
+
+
+class FrontierFile:
+    def __init__(self, temp_dir=None):
+        handle, self.path = tempfile.mkstemp(prefix="potanalyzer_", suffix=".frontier", dir=temp_dir)
+        self.frontier_file = os.fdopen(handle, "w", encoding="utf-8", newline="\n", buffering=1024 * 1024)
+        self.count = 0
+
+    def write(self, password):
+        self.frontier_file.write(password)
+        self.frontier_file.write("\n")
+        self.count += 1
+
+    def finish(self):
+        self.frontier_file.close()
+
+    def iterate_rows(self):
+        for password in potreader.PotfileReader(self.path).iterate_words():
+            yield (password,)
+
+    def remove(self):
+        if not self.frontier_file.closed:
+            self.frontier_file.close()
+        os.remove(self.path)
+
+
+class CandidateStream:
+    def __init__(self, output, capacity=default_stream_capacity,
+                 false_positive_rate=bloomfilter.default_false_positive_rate, max_output_depth=None):
+        self.output = output
+        self.seen = bloomfilter.BloomFilter(capacity, false_positive_rate)
+        self.max_output_depth = max_output_depth
+        self.emitted_count = 0
+
+    def add_many(self, passwords, depth, frontier=None):
+        block = []
+        for password in passwords:
+            if self.seen.add_if_absent(password):
+                block.append(password)
+        if frontier is not None:
+            for password in block:
+                frontier.write(password)
+        if len(block) > 0 and (self.max_output_depth is None or depth <= self.max_output_depth):
+            self.output.write("\n".join(block).encode("utf-8"))
+            # A reader that closes the pipe early may still have taken the block before its trailing newline
+            self.emitted_count += len(block)
+            self.output.write(b"\n")
+        return len(block)
+
+    def flush(self):
+        self.output.flush()
+
+    def discard_output(self):
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, self.output.fileno())
+        os.close(devnull)
+
+    def close(self):
+        try:
+            self.output.flush()
+            if self.output.fileno() != sys.__stdout__.fileno():
+                self.output.close()
+        except BrokenPipeError:
+            self.discard_output()
+        self.seen.close()
@@ -0,0 +1,50 @@
+import hashlib
+import random
+from analyzertools import masktools
+
+default_charset_weights = (60, 15, 20, 5)
+default_length_range = (6, 12)
+character_pools = (masktools.alpha_lower_pool, masktools.alpha_upper_pool, masktools.digit_pool,
+                   masktools.special_pool.replace(":", ""))
+
+
+def parse_charset_weights(weight_string):
+    weights = tuple(float(weight) for weight in weight_string.split(":"))
+    if len(weights) != len(character_pools) or sum(weights) <= 0:
+        raise ValueError("Expected four lower:upper:digit:special weights, got '%s'" % weight_string)
+    return weights
+
+
+def parse_length_range(range_string):
+    if "-" in range_string:
+        minimum, maximum = range_string.split("-", 1)
+    else:
+        minimum = maximum = range_string
+    minimum, maximum = int(minimum), int(maximum)
+    if minimum < 1 or maximum < minimum:
+        raise ValueError("Invalid password length range '%s'" % range_string)
+    return minimum, maximum
+
+
+class PasswordGenerator:
+    def __init__(self, length_range=default_length_range, charset_weights=default_charset_weights, seed=0):
+        self.length_range = length_range
+        self.charset_weights = charset_weights
+        self.random = random.Random(seed)
+
+    def next_password(self):
+        length = self.random.randint(self.length_range[0], self.length_range[1])
+        pools = self.random.choices(character_pools, self.charset_weights, k=length)
+        return "".join([self.random.choice(pool) for pool in pools])
+
+    def generate(self, count):
+        return [self.next_password() for _ in range(count)]
+
+
+def write_potfile(filename, passwords):
+    with open(filename, "w", encoding="utf-8", newline="\n") as potfile:
+        for password in passwords:
+            potfile.write(hashlib.md5(password.encode("utf-8")).hexdigest())
+            potfile.write(":")
+            potfile.write(password)
+            potfile.write("\n")